@@ -0,0 +1,44 @@
+from promptflow import tool
+import numpy as np
+import json
+import re
+
+METRICS = ["coherence", "fluency", "groundedness", "relevance"]
+
+
+def parse_scores(combined_score: str) -> dict:
+    # combined_score runs in JSON mode, the regexes are for deployments without it
+    match = re.search(r'\{.*\}', combined_score, re.DOTALL)
+    if match:
+        try:
+            return {str(name).lower(): value for name, value in json.loads(match.group()).items()}
+        except ValueError:
+            pass
+    return {name: value for name, value in re.findall(r'"?(\w+)"?\s*[:=]\s*(\d)', combined_score.lower())}
+
+
+@tool
+def concat_results(combined_score: str):
+
+    scores = parse_scores(combined_score)
+    load_list = [{'name': 'gpt_' + metric, 'score': scores.get(metric)} for metric in METRICS]
+    score_list = []
+    errors = []
+    for item in load_list:
+        try:
+            score = str(item["score"])
+            match = re.search(r'\d', score)
+            if match:
+                score = match.group()
+            score = float(score)
+        except Exception as e:
+            score = np.nan
+            errors.append({"name": item["name"], "msg":   str(e), "data": item["score"]})
+        score_list.append({"name": item["name"], "score": score})
+
+    variant_level_result = {}
+    for item in score_list:
+        item_name = str(item["name"])
+        variant_level_result[item_name] = item["score"]
+        variant_level_result[item_name + '_pass_rate'] = 1 if item["score"] > 3 else 0
+    return variant_level_result
@@ -1,6 +1,6 @@
 import openai
 import chainlit as cl
-from chat_util import PromptFlowChat
+from chat_util import PromptFlowChat, load_cached_flow
 import promptflow as pf
 import os
 import yaml, json
@@ -118,7 +118,11 @@ async def call_chat(question: str, question_id: str, context=None):
 
     msg = cl.Message(content="")
     context = None
-    for chunk in response:
+    while True:
+        # read the stream off the event loop, tokens arrive while the model generates them
+        chunk = await cl.make_async(next)(response, None)
+        if chunk is None:
+            break
         if chunk["object"] == "chat.completion.chunk":
             if "content" in chunk["choices"][0]["delta"]:
                 token = chunk["choices"][0]["delta"].get("content", "")
@@ -139,6 +143,8 @@ async def call_chat(question: str, question_id: str, context=None):
                 if "query_rewrite" in context:
                     await cl.Message(content=f"#### Query Rewrite:\n{context['query_rewrite']}", parent_id=question_id).send()
 
+    if chat_app.metrics:
+        await cl.Message(content=f"#### Streaming:\n```yaml\n{yaml.dump(chat_app.metrics[-1])}\n```", parent_id=question_id).send()
     await cl.Message(content=f"#### Download as testcase:\n```json\n{json.dumps(test_case)}\n```", parent_id=question_id).send()
 
     message_history.append({"role": "assistant", "content": msg.content})
@@ -158,15 +164,15 @@ async def call_eval(command: str, command_id: str):
     question = messages[-2]["content"]
     answer = messages[-1]["content"]
     context = messages[-1]["context"]["context"]
-    cli = pf.PFClient()
-    result = await cl.make_async(cli.test)(config["evalflow"], inputs=dict(
+    eval_flow = load_cached_flow(config["evalflow"])
+    result = await cl.make_async(eval_flow)(
         chat_history=chat_history,
         question=question,
         answer=answer,
         context=context
-    ))
+    )
 
-    await cl.Message(content=f"```yaml\n{yaml.dump(result)}```").send()
+    await cl.Message(content=f"```yaml\n{yaml.dump(dict(result))}```").send()
 
 async def list_tests(command: str, command_id: str):
     test_set = cl.user_session.get("config")["test_set"]
@@ -1,8 +1,37 @@
 from dotenv import load_dotenv, find_dotenv
 import importlib, os
 import yaml
-import os, openai
+import os, openai, time, threading
 import promptflow as pf
+from functools import lru_cache
+
+# Loading a flow parses its dag, loads its tools and resolves its connections, so loaded
+# flows are kept for the lifetime of the process and reloaded only when flow.dag.yaml changes.
+_flows = {}
+_flows_lock = threading.Lock()
+
+def _dag_file(prompt_flow):
+    return os.path.join(os.path.abspath(prompt_flow), "flow.dag.yaml")
+
+def load_cached_flow(prompt_flow, streaming=False):
+    """Returns a loaded, ready to call flow for the flow directory prompt_flow"""
+    dag_file = _dag_file(prompt_flow)
+    mtime = os.path.getmtime(dag_file)
+    # the streaming setting lives on the flow, so streaming and non-streaming callers get their own
+    key = (dag_file, streaming)
+    with _flows_lock:
+        entry = _flows.get(key)
+        if entry is None or entry[0] != mtime:
+            flow = pf.load_flow(os.path.dirname(dag_file))
+            flow.context.streaming = streaming
+            entry = (mtime, flow)
+            _flows[key] = entry
+        return entry[1]
+
+@lru_cache(maxsize=32)
+def _read_dag(dag_file, mtime):
+    with open(dag_file, "r") as f:
+        return yaml.safe_load(f)
 
 class ChatApp:
     context :dict = {}
@@ -16,12 +45,13 @@ class PromptFlowChat(ChatApp):
         self.question = question_name
         self.answer = answer_name
         self.chat_history = messages_name
+        # time to first token and tokens/sec of every answer, most recent last
+        self.metrics = []
 
     def find_input_output_names(self, prompt_flow):
-        prompt_flow = os.path.join(prompt_flow, "flow.dag.yaml")
+        dag_file = _dag_file(prompt_flow)
         messages_name, question_name, answer_name = None, None, None
-        with open( prompt_flow, "r") as f:
-            prompt_flow = yaml.safe_load(f)
+        prompt_flow = _read_dag(dag_file, os.path.getmtime(dag_file))
         # find the field in the flow that has the is_chat_input: true
         for name, field in prompt_flow["inputs"].items():
             if "is_chat_input" in field and field["is_chat_input"]:
@@ -40,19 +70,39 @@ class PromptFlowChat(ChatApp):
     def __call__(self, messages, stream=False, context={}, session_state={}) -> str:
         return self.chat_completion(messages=messages, stream=stream, context=context)
 
-    def stream_response(self, answer, result):
+    def stream_response(self, answer, result, start_time):
         response = {"object": "chat.completion.chunk", "choices": []}
         response["choices"].append({"index": 0, 
                                     "delta": {"role": "assistant", 
                                               "context": result}})
         yield response
 
-        for token in answer:
+        for token in self.timed_tokens(answer, start_time):
             response = {"object": "chat.completion.chunk", "choices": []}
             response["choices"].append({"index": 0, 
                                         "delta": {"content": token}})
             yield response
 
+    def timed_tokens(self, answer, start_time):
+        """
+            yields the tokens of the answer as the flow produces them and records the time to 
+            the first token and the tokens per second once the answer is complete
+        """
+        tokens = [answer] if isinstance(answer, str) else answer
+        count, first_token_time = 0, None
+        for token in tokens:
+            if first_token_time is None:
+                first_token_time = time.perf_counter()
+            count += 1
+            yield token
+        end_time = time.perf_counter()
+        first_token_time = first_token_time or end_time
+        generation_time = end_time - first_token_time
+        self.metrics.append({"time_to_first_token": first_token_time - start_time,
+                             "tokens": count,
+                             "tokens_per_second": count / generation_time if generation_time > 0 else None,
+                             "total_time": end_time - start_time})
+
     def chat_completion(self, messages, stream, context={}, session_state={}):
         adjusted_kwargs = context.copy()
         adjusted_kwargs[self.question] = messages[-1]["content"]
@@ -62,8 +112,11 @@ class PromptFlowChat(ChatApp):
         elif len(pf_chat_history) > 0:
             raise ValueError(f"chat_history in context with non-empty chat history: {pf_chat_history}")
 
-        cli = pf.PFClient()
-        result = cli.test(self.prompt_flow, inputs=adjusted_kwargs)
+        start_time = time.perf_counter()
+        # with streaming on, the flow returns as soon as the llm node starts generating
+        # and the answer is a generator of tokens
+        flow = load_cached_flow(self.prompt_flow, streaming=stream)
+        result = dict(flow(**adjusted_kwargs))
 
         if self.answer is not None:  
             answer = result.pop(self.answer)
@@ -71,13 +124,13 @@ class PromptFlowChat(ChatApp):
             answer = None
 
         if stream:
-            return self.stream_response(answer, result)
+            return self.stream_response(answer, result, start_time)
         else:
             # non-streaming response
-            # but the promptflow is streaming, so we need to read out the interator
+            # but the promptflow may still stream, so we need to read out the interator
             if hasattr(answer, "__iter__") and hasattr(answer, "__next__"):
                 answer_text = ""
-                for token in answer:
+                for token in self.timed_tokens(answer, start_time):
                     answer_text += token
                 answer = answer_text
 
@@ -1,4 +1,4 @@
-from chat_util import PromptFlowChat
+from chat_util import PromptFlowChat, load_cached_flow
 import json 
 from dotenv import load_dotenv
 
@@ -6,7 +6,8 @@ load_dotenv()
 
 import concurrent.futures
 import json
-import os, time
+import hashlib, os, random, sys, threading, time
+import yaml
 
 from azure.ai.resources.client import AIClient
 from azure.identity import DefaultAzureCredential, InteractiveBrowserCredential
@@ -14,6 +15,10 @@ from azure.ai.generative.evaluate import evaluate
 import tempfile, os
 import promptflow as pf
 
+# the token bucket of the embedding step of init_search.py
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "search"))
+from embeddings import TokenRateLimiter
+
 def process_test(chat, line_number, test):
     messages = chat._chat_history_to_openai(chat_history=test["chat_history"], 
                                             question=test["question"])
@@ -29,24 +34,206 @@ def process_test(chat, line_number, test):
     messages.append(reply_message)
     return line_number, {"messages":messages}
 
-def batch_run(prompt_flow, tests, test_set_result_file):
+# Flow runs in flight during a batch run, lowered while AOAI, Cosmos or Search throttle us.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_RETRIES = 6
+
+class AdaptiveLimit:
+    """
+    Lets at most limit rows run at once. The limit is halved when a row is throttled
+    and grows back by one after limit rows in a row succeed.
+    """
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.running = 0
+        self.successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.running >= self.limit:
+                self._condition.wait()
+            self.running += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.running -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self._condition.notify_all()
+
+def is_throttled(error):
+    # promptflow wraps the errors of its tools, look for a 429 along the chain
+    while error is not None:
+        if getattr(error, "status_code", None) == 429 or "Error code: 429" in str(error):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+def run_test(chat, limit, line_number, test):
+    start_time = time.time()
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        limit.acquire()
+        try:
+            _, result = process_test(chat, line_number, test)
+        except Exception as e:
+            limit.release(throttled=is_throttled(e))
+            if not is_throttled(e) or attempt == BATCH_MAX_RETRIES:
+                raise
+            wait = min(60, 2 ** attempt) + random.random()
+            print(f"test {line_number} was throttled, retrying in {wait:.1f}s with up to {limit.limit} tests in parallel")
+            time.sleep(wait)
+            continue
+        limit.release()
+        return line_number, result, time.time() - start_time
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0.0
+
+def peak_memory_mb():
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# Replies of completed tests by test key, appended as tests complete so that a
+# crashed or repeated batch run only runs the tests that are missing or changed.
+REPLY_CHECKPOINT_PATH = os.getenv("REPLY_CHECKPOINT_PATH", ".cache/replies.checkpoint.jsonl")
+
+def flow_version(prompt_flow):
+    """a hash of the source files of the flow, replies of an edited flow aren't reused"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(prompt_flow):
+        # skip generated folders like .promptflow and __pycache__
+        dirs[:] = sorted(d for d in dirs if not d.startswith((".", "__")))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, prompt_flow).replace(os.sep, "/").encode("utf-8"))
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    # files shared with other flows are copied in when the flow runs
+    with open(os.path.join(prompt_flow, "flow.dag.yaml")) as f:
+        additional_includes = yaml.safe_load(f).get("additional_includes", [])
+    for include in additional_includes:
+        digest.update(include.encode("utf-8"))
+        with open(os.path.join(prompt_flow, include), "rb") as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def test_key(version, test):
+    return hashlib.sha256(json.dumps([version, test.get("customerId"), test.get("chat_history"), test["question"]],
+                                     sort_keys=True).encode("utf-8")).hexdigest()
+
+def read_checkpoint(checkpoint_file):
+    """
+    returns the offsets of the completed replies in the checkpoint by test key, and
+    cuts off a reply that was only partially written when a run crashed
+    """
+    offsets = {}
+    if not os.path.exists(checkpoint_file):
+        return offsets
+    with open(checkpoint_file, "rb+") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                f.truncate(offset)
+                break
+            offsets[json.loads(line)["key"]] = offset
+            offset += len(line)
+    return offsets
+
+def read_reply_rows(test_set_result_file):
+    """the lines of test_set_result_file in test order, with the index and key of their test"""
+    with open(test_set_result_file) as f:
+        replies = [json.loads(line) for line in f]
+    # files written before the index column are already in test order
+    order = sorted(range(len(replies)), key=lambda line: replies[line].get("index", line))
+    return [dict(replies[line], index=replies[line].get("index", line)) for line in order]
+
+def read_replies(test_set_result_file):
+    return [{"messages": reply["messages"]} for reply in read_reply_rows(test_set_result_file)]
+
+def speculation_decisions(stats):
+    return stats["keep"] + stats["merge"] + stats["discard"]
+
+def batch_run(prompt_flow, tests, test_set_result_file, concurrency=BATCH_CONCURRENCY, rerun=False):
+    """
+    Runs the tests through the flow with at most concurrency tests in flight, backing
+    off when throttled. Tests are keyed by the flow version and their customerId,
+    chat_history and question: replies are checkpointed by key as they complete, and
+    tests with a checkpointed reply are only run again with rerun. The replies are
+    written to test_set_result_file with the "index" of their test, and returned in
+    test order.
+    """
     cwd = os.getcwd()
-    print(f"batch run {len(tests)} tests in parallel...")
+    test_set_result_file = os.path.abspath(test_set_result_file)
+    checkpoint_file = os.path.abspath(REPLY_CHECKPOINT_PATH)
+    if os.path.dirname(checkpoint_file):
+        os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    version = flow_version(prompt_flow)
+    keys = [test_key(version, test) for test in tests]
+    offsets = {} if rerun else read_checkpoint(checkpoint_file)
+    pending = [line_number for line_number, key in enumerate(keys) if key not in offsets]
+    print(f"batch run {len(pending)} of {len(tests)} tests ({len(tests) - len(pending)} already answered), {concurrency} in parallel...")
     os.chdir(prompt_flow)
     chat = PromptFlowChat(".")
+    limit = AdaptiveLimit(concurrency)
+    latencies = []
+    failed = 0
+    # the flow's speculative retrieval counters (cumulative in this process), when it's on
+    speculation = None
     start_time = time.time()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(tests)) as executor:
-        results = executor.map(process_test, [chat]*len(tests), range(len(tests)), tests)
-    print(f"done -- {time.time() - start_time} seconds for {len(tests)} tests. {(time.time() - start_time)/len(tests)} seconds per test")
-
-    sorted_results = sorted(results, key=lambda x: x[0])
-    sorted_results = [result[1] for result in sorted_results]
+    with open(checkpoint_file, "ab") as f, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(run_test, chat, limit, line_number, tests[line_number]): line_number
+                   for line_number in pending}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                line_number, result, latency = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"test {futures[future]} failed: {e}")
+                continue
+            offsets[keys[line_number]] = f.tell()
+            f.write(json.dumps(dict(key=keys[line_number], **result)).encode("utf-8") + b"\n")
+            f.flush()
+            latencies.append(latency)
+            stats = result["messages"][-1]["context"].get("speculation")
+            # replies complete out of order, keep the counters with the most decisions
+            if stats and (speculation is None or speculation_decisions(stats) >= speculation_decisions(speculation)):
+                speculation = stats
     os.chdir(cwd)
-    with open(test_set_result_file, "w") as f:
-        for result in sorted_results:
-            f.write(json.dumps(result) + "\n")
+    elapsed = max(time.time() - start_time, 1e-9)
+    peak_memory = peak_memory_mb()
+    print(f"done -- {elapsed:.1f} seconds for {len(latencies)} tests ({failed} failed). {len(latencies) / elapsed:.2f} tests per second, "
+          f"p50 {percentile(latencies, 50):.2f}s, p95 {percentile(latencies, 95):.2f}s per test, "
+          f"peak memory {f'{peak_memory:.0f} MB' if peak_memory is not None else 'n/a'}")
+    if speculation is not None:
+        print(f"speculative retrieval: {speculation['keep']} kept, {speculation['merge']} merged, {speculation['discard']} discarded "
+              f"({speculation['used_rate']:.0%} used), {speculation['saved_seconds']:.1f}s of search saved")
+
+    # the replies of this test set, in test order
+    with open(checkpoint_file, "rb") as checkpoint, open(test_set_result_file, "w") as f:
+        for line_number, key in enumerate(keys):
+            if key not in offsets:
+                continue
+            checkpoint.seek(offsets[key])
+            reply = json.loads(checkpoint.readline())
+            f.write(json.dumps(dict(index=line_number, **reply)) + "\n")
     print("saved to", test_set_result_file)
-    return sorted_results
+    return read_replies(test_set_result_file)
 
 
 def read_eval_artifacts(result):
@@ -84,43 +271,155 @@ def evaluate_test_set(client, batch_results):
 
     return result
 
-def evaluate_prompt_flow(prompt_flow, eval_flow, batch_results):
+# Eval flow rows in flight, and the GPT-4 requests per minute they may send between them.
+EVAL_CONCURRENCY = int(os.getenv("EVAL_CONCURRENCY", "4"))
+EVAL_REQUESTS_PER_MINUTE = int(os.getenv("EVAL_REQUESTS_PER_MINUTE", "60"))
+# scorer calls per row of eval_flow (coherence, fluency, groundedness, relevance)
+EVAL_CALLS_PER_ROW = 4
+
+def evaluate_row(chat_app, eval_app, limit, rate_limiter, line_number, test, calls_per_row):
+    messages = test["messages"]
+    inputs = dict(
+        chat_history=chat_app._chat_history_to_pf(messages[:-2]),
+        question=messages[-2]["content"],
+        answer=messages[-1]["content"],
+        context=json.dumps({"citations": messages[-1]["context"]["citations"]})
+    )
     start_time = time.time()
+    for attempt in range(BATCH_MAX_RETRIES + 1):
+        rate_limiter.acquire(calls_per_row)
+        limit.acquire()
+        try:
+            # the scorer nodes don't depend on each other, the flow runs them in parallel
+            result = eval_app(**inputs)
+        except Exception as e:
+            limit.release(throttled=is_throttled(e))
+            if not is_throttled(e) or attempt == BATCH_MAX_RETRIES:
+                raise
+            wait = min(60, 2 ** attempt) + random.random()
+            print(f"evaluation {line_number} was throttled, retrying in {wait:.1f}s")
+            time.sleep(wait)
+            continue
+        limit.release()
+        return line_number, dict(result), time.time() - start_time
 
+def evaluate_prompt_flow(prompt_flow, eval_flow, batch_results, concurrency=EVAL_CONCURRENCY,
+                         requests_per_minute=EVAL_REQUESTS_PER_MINUTE, calls_per_row=EVAL_CALLS_PER_ROW):
+    """
+    Scores the batch results with the eval flow, concurrency rows at a time and at most
+    requests_per_minute scorer calls. Returns the scores of each row in row order, None
+    for rows that failed.
+    """
     chat_app = PromptFlowChat(prompt_flow=prompt_flow)
-    results = []
-    for test in batch_results:
-        messages = test["messages"]
-        chat_history = chat_app._chat_history_to_pf(messages[:-2])
-        question = messages[-2]["content"]
-        answer = messages[-1]["content"]
-        # customer_data = messages[-1]["context"]["customer_data"]
-        citations = messages[-1]["context"]["citations"]
-        context = json.dumps({"citations": citations})
-        cli = pf.PFClient()
-        result = cli.test(eval_flow, inputs=dict(
-            chat_history=chat_history,
-            question=question,
-            answer=answer,
-            context=context
-        ))
-        print("result:", result)
-        results.append(result)
-    print(f"done -- {time.time() - start_time} seconds for {len(batch_results)} tests. {(time.time() - start_time)/len(batch_results)} seconds per evaluation")
+    eval_app = load_cached_flow(eval_flow)
+    limit = AdaptiveLimit(concurrency)
+    # one token per scorer call
+    rate_limiter = TokenRateLimiter(requests_per_minute)
+    results = [None] * len(batch_results)
+    latencies = []
+    print(f"evaluating {len(batch_results)} replies, {concurrency} in parallel at up to {requests_per_minute} requests per minute...")
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(evaluate_row, chat_app, eval_app, limit, rate_limiter, line_number, test, calls_per_row): line_number
+                   for line_number, test in enumerate(batch_results)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                line_number, result, latency = future.result()
+            except Exception as e:
+                print(f"evaluation {futures[future]} failed: {e}")
+                continue
+            print("result:", result)
+            results[line_number] = result
+            latencies.append(latency)
+    elapsed = max(time.time() - start_time, 1e-9)
+    # the rows' own latencies add up to what running them one at a time would take
+    print(f"done -- {elapsed:.1f} seconds wall clock for {len(latencies)} evaluations, {sum(latencies):.1f} seconds one at a time "
+          f"({sum(latencies) / elapsed:.1f}x). p50 {percentile(latencies, 50):.2f}s, p95 {percentile(latencies, 95):.2f}s per evaluation")
 
     return results
 
+METRICS = ["gpt_coherence", "gpt_fluency", "gpt_groundedness", "gpt_relevance"]
+
+def parity_report(separate_results, combined_results):
+    """
+    Compares the scores of the four-call eval flow with the single-call one
+    (eval_flow/combined) row by row. Returns, per metric, the rows both scored, how
+    often the scores are equal, within one star of each other and agree on passing
+    (a score above 3), the mean scores and the mean absolute difference.
+    """
+    report = {}
+    for metric in METRICS:
+        pairs = []
+        for separate, combined in zip(separate_results, combined_results):
+            if separate is None or combined is None:
+                continue
+            try:
+                pair = float(separate[metric]), float(combined[metric])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if pair[0] == pair[0] and pair[1] == pair[1]:
+                pairs.append(pair)
+        n = len(pairs)
+        report[metric] = {
+            "rows": n,
+            "exact_agreement": sum(a == b for a, b in pairs) / n if n else None,
+            "within_one": sum(abs(a - b) <= 1 for a, b in pairs) / n if n else None,
+            "pass_agreement": sum((a > 3) == (b > 3) for a, b in pairs) / n if n else None,
+            "mean_separate": sum(a for a, _ in pairs) / n if n else None,
+            "mean_combined": sum(b for _, b in pairs) / n if n else None,
+            "mean_absolute_difference": sum(abs(a - b) for a, b in pairs) / n if n else None,
+        }
+    for metric, row in report.items():
+        print(metric + ": " + ", ".join(f"{name} {value:.2f}" if isinstance(value, float) else f"{name} {value}"
+                                        for name, value in row.items()))
+    return report
+
 if __name__ == "__main__":
     print("cwd:", os.getcwd())
     test_set_file = "data/testdata.jsonl"
     test_set_result_file = "data/replies.jsonl"
     prompt_flow = "rag_flow"
     eval_flow = "eval_flow"
+    # columnar copy of the replies and eval scores, see reply_store.py
+    reply_store_path = "data/replies"
+
+    if "--local-eval" in sys.argv and "--store" in sys.argv:
+        # score the replies of the store and aggregate the scores stored next to them
+        from reply_store import read_batch_results, write_eval_results, aggregate_eval_results
+        results = evaluate_prompt_flow(prompt_flow, eval_flow, read_batch_results(reply_store_path))
+        write_eval_results(reply_store_path, results)
+        print(aggregate_eval_results(reply_store_path))
+        sys.exit(0)
+
+    if "--local-eval" in sys.argv:
+        batch_results = read_replies(test_set_result_file)
+        if "--compare-concurrency" in sys.argv:
+            # wall clock of scoring the saved replies one row at a time and concurrently,
+            # without the LLM cache so both runs call the model
+            os.environ["LLM_CACHE_BYPASS"] = "1"
+            for concurrency in [1, EVAL_CONCURRENCY]:
+                evaluate_prompt_flow(prompt_flow, eval_flow, batch_results, concurrency=concurrency)
+            sys.exit(0)
+        if "--combined" in sys.argv:
+            # the single-call variant of the eval flow against the four-call one
+            separate_results = evaluate_prompt_flow(prompt_flow, eval_flow, batch_results)
+            combined_results = evaluate_prompt_flow(prompt_flow, os.path.join(eval_flow, "combined"), batch_results,
+                                                    calls_per_row=1)
+            parity_report(separate_results, combined_results)
+            sys.exit(0)
+        # one pass, rows scored before are served from the LLM cache
+        evaluate_prompt_flow(prompt_flow, eval_flow, batch_results)
+        sys.exit(0)
 
     with open(test_set_file) as f:
         test_set = [json.loads(line) for line in f]
     
     batch_results = batch_run(prompt_flow, test_set, test_set_result_file)
+    if "--store" in sys.argv:
+        from reply_store import write_reply_store
+        # the rows of the replies file still have the index and key of their test
+        write_reply_store(reply_store_path, read_reply_rows(test_set_result_file))
+        print("saved to", reply_store_path)
 
     client = AIClient.from_config(DefaultAzureCredential())
     result = evaluate_test_set(client, batch_results)
@@ -0,0 +1,105 @@
+"""
+Prompt tokens of the test set before and after the token budget of assemble_context,
+computed offline: customers come from data/customer_info, documentation from the local
+index (hybrid search when the embedding cache has the question, BM25 otherwise) and
+the prompt is rendered from the templates of the flow.
+
+  python exp/prompt_tokens.py [--local-index data/local_index] [--token-budget 3000]
+
+Build the local index with 'python search/init_search.py --local-only'. The flow
+searches with the rewritten query, the raw question stands in for it here.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+
+import jinja2
+
+FLOW = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rag_flow")
+sys.path.append(FLOW)
+from assemble_context import assemble_context, get_encoding
+from customer_lookup import most_recent
+from embedding_cache import get_embedding_cache
+from local_index import LocalIndex
+from merge_chunks import merge_chunks
+
+EMBEDDING_DEPLOYMENT = "text-embedding-ada-002"
+# as set on the nodes of rag_flow/flow.dag.yaml
+MAX_ORDERS = 3
+TOP = 6
+
+
+def load_customers(path: str = "data/customer_info") -> dict:
+    customers = {}
+    for file in glob.glob(os.path.join(path, "*.json")):
+        with open(file) as f:
+            customer = json.load(f)
+        customers[str(customer["id"])] = customer
+    return customers
+
+
+def load_template(name: str) -> jinja2.Template:
+    # the options promptflow renders prompt templates with
+    with open(os.path.join(FLOW, name), encoding="utf-8") as f:
+        return jinja2.Template(f.read(), trim_blocks=True, keep_trailing_newline=True)
+
+
+def retrieve(index: LocalIndex, question: str, cache) -> list:
+    embedding = cache.get(EMBEDDING_DEPLOYMENT, question) if cache is not None else None
+    if embedding is not None:
+        return index.retrieve(embedding, top=TOP, mode="hybrid" if index.bm25 is not None else "exact", question=question)
+    if index.bm25 is None:
+        raise ValueError(f"{question!r} is not in the embedding cache and local index {index.path} has no BM25 index")
+    indices, _ = index.bm25.search(question, top=TOP)
+    return [dict(index.documents[i]) for i in indices]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prompt tokens of the test set before and after the token budget")
+    parser.add_argument("--test-set", default="data/testdata.jsonl")
+    parser.add_argument("--local-index", default="data/local_index")
+    parser.add_argument("--embedding-cache", default=".cache/embeddings.sqlite")
+    parser.add_argument("--token-budget", type=int, default=3000)
+    parser.add_argument("--encoding", default="cl100k_base")
+    args = parser.parse_args()
+
+    index = LocalIndex(args.local_index)
+    cache = get_embedding_cache(args.embedding_cache) if os.path.exists(args.embedding_cache) else None
+    customers = load_customers()
+    customer_prompt = load_template("customer_prompt.jinja2")
+    llm_call = load_template("llm_call.jinja2")
+    encoding = get_encoding(args.encoding)
+
+    def prompt_tokens(question, documentation, customer, chat_history) -> int:
+        system = customer_prompt.render(documentation=documentation, customer=customer)
+        return len(encoding.encode(llm_call.render(prompt_text=system, history=chat_history, question=question)))
+
+    with open(args.test_set) as f:
+        tests = [json.loads(line) for line in f if line.strip()]
+    before, after = [], []
+    for line_number, test in enumerate(tests):
+        customer = customers.get(str(test["customerId"]))
+        if customer is None:
+            print(f"test {line_number}: no customer {test['customerId']} in data/customer_info, skipped")
+            continue
+        customer = dict(customer, orders=most_recent(customer["orders"], MAX_ORDERS))
+        documentation = merge_chunks(retrieve(index, test["question"], cache))
+        context = assemble_context(test["question"], documentation, customer, test["chat_history"],
+                                   token_budget=args.token_budget, encoding_name=args.encoding)
+        before.append(prompt_tokens(test["question"], documentation, customer, test["chat_history"]))
+        after.append(prompt_tokens(test["question"], context["documentation"], context["customer"], context["chat_history"]))
+        cut = context["cut"]
+        print(f"test {line_number}: {before[-1]} -> {after[-1]} prompt tokens, "
+              f"{len(cut['citations'])} citations and {len(cut['orders'])} orders dropped, "
+              f"{len(cut['truncated_citations']) + len(cut['truncated_orders'])} truncated, {cut['history_turns']} history turns dropped")
+
+    if before:
+        print(f"{len(before)} tests with a budget of {args.token_budget} tokens for the variable parts: "
+              f"mean {sum(before) / len(before):.0f} -> {sum(after) / len(after):.0f} prompt tokens, "
+              f"max {max(before)} -> {max(after)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+A columnar store (Parquet) for batch run replies and their eval scores.
+
+The replies of a batch run repeat the same citations and customer data in many
+rows, each reply carries them twice (as citations and in the flow context) and the
+customer data once more as a stringified "Customer information" citation. The store
+keeps every citation and every customer once, in their own tables, and the replies
+refer to them by id:
+
+  replies.parquet    index, key, history (JSON), question, answer, query_rewrite,
+                     citation_ids, customer_key, extra_context (JSON)
+  citations.parquet  citation_key, id, title, content, sourcefile, url
+  customers.parquet  customer_key, customer_id, data (JSON)
+  eval.parquet       index and the gpt_* scores and pass rates of each reply
+
+Needs pyarrow and pandas, install them with 'pip install pyarrow pandas'.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Iterable, List
+
+try:
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    raise ImportError("the reply store needs pyarrow and pandas, install them with 'pip install pyarrow pandas'")
+
+REPLIES_FILE = "replies.parquet"
+CITATIONS_FILE = "citations.parquet"
+CUSTOMERS_FILE = "customers.parquet"
+EVAL_FILE = "eval.parquet"
+
+CUSTOMER_CITATION_TITLE = "Customer information"
+CITATION_FIELDS = ["id", "title", "content", "sourcefile", "url"]
+# context keys of the reply with columns or tables of their own, the others (like
+# context_cut) are kept as they are in extra_context
+CONTEXT_KEYS = {"citations", "context", "query_rewrite"}
+
+REPLIES_SCHEMA = pa.schema([
+    ("index", pa.int64()),
+    ("key", pa.string()),
+    ("history", pa.string()),
+    ("question", pa.string()),
+    ("answer", pa.string()),
+    ("query_rewrite", pa.string()),
+    ("citation_ids", pa.list_(pa.string())),
+    ("customer_key", pa.string()),
+    ("extra_context", pa.string()),
+])
+
+# replies are written a row group at a time so memory doesn't grow with the run
+ROW_GROUP_SIZE = 10000
+
+
+def _key(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def write_reply_store(path: str, replies: Iterable[dict]):
+    """
+    writes replies (the rows of replies.jsonl, as eval.read_reply_rows returns them
+    with the index and key of their test) to the store directory path
+    """
+    os.makedirs(path, exist_ok=True)
+    citations = {}
+    customers = {}
+    rows = {name: [] for name in REPLIES_SCHEMA.names}
+    with pq.ParquetWriter(os.path.join(path, REPLIES_FILE), REPLIES_SCHEMA) as writer:
+        for line_number, reply in enumerate(replies):
+            messages = reply["messages"]
+            context = messages[-1].get("context", {})
+            customer_data = context.get("context", {}).get("customer_data")
+            citation_ids = []
+            for citation in context.get("citations", []):
+                # rebuilt from the customer data when reading
+                if citation.get("title") == CUSTOMER_CITATION_TITLE and customer_data is not None:
+                    continue
+                key = _key(citation)
+                citations.setdefault(key, citation)
+                citation_ids.append(key)
+            customer_key = None
+            if customer_data is not None:
+                customer_key = _key(customer_data)
+                customers.setdefault(customer_key, customer_data)
+
+            rows["index"].append(reply.get("index", line_number))
+            rows["key"].append(reply.get("key"))
+            rows["history"].append(json.dumps(messages[:-2]))
+            rows["question"].append(messages[-2]["content"])
+            rows["answer"].append(messages[-1]["content"])
+            rows["query_rewrite"].append(context.get("query_rewrite"))
+            rows["citation_ids"].append(citation_ids)
+            rows["customer_key"].append(customer_key)
+            extra = {name: value for name, value in context.items() if name not in CONTEXT_KEYS}
+            rows["extra_context"].append(json.dumps(extra) if extra else None)
+            if len(rows["index"]) == ROW_GROUP_SIZE:
+                writer.write_table(pa.table(rows, schema=REPLIES_SCHEMA))
+                rows = {name: [] for name in REPLIES_SCHEMA.names}
+        if rows["index"]:
+            writer.write_table(pa.table(rows, schema=REPLIES_SCHEMA))
+
+    pq.write_table(pa.table({
+        "citation_key": list(citations.keys()),
+        **{field: [citation.get(field) for citation in citations.values()] for field in CITATION_FIELDS},
+    }), os.path.join(path, CITATIONS_FILE))
+    pq.write_table(pa.table({
+        "customer_key": list(customers.keys()),
+        "customer_id": [str(customer.get("id")) for customer in customers.values()],
+        "data": [json.dumps(customer) for customer in customers.values()],
+    }), os.path.join(path, CUSTOMERS_FILE))
+
+
+def read_replies_table(path: str) -> pd.DataFrame:
+    """the replies of the store, one row per reply in test order"""
+    return pd.read_parquet(os.path.join(path, REPLIES_FILE)).sort_values("index", ignore_index=True)
+
+
+def read_citations_table(path: str) -> pd.DataFrame:
+    return pd.read_parquet(os.path.join(path, CITATIONS_FILE))
+
+
+def read_customers_table(path: str) -> pd.DataFrame:
+    return pd.read_parquet(os.path.join(path, CUSTOMERS_FILE))
+
+
+def reply_citations(path: str) -> pd.DataFrame:
+    """one row per cited document of each reply (index, position, citation columns)"""
+    replies = read_replies_table(path)[["index", "citation_ids"]].explode("citation_ids")
+    replies["position"] = replies.groupby("index").cumcount()
+    return replies.merge(read_citations_table(path), left_on="citation_ids", right_on="citation_key") \
+                  .drop(columns=["citation_ids"]).sort_values(["index", "position"], ignore_index=True)
+
+
+def read_batch_results(path: str) -> List[dict]:
+    """
+    the replies in the shape eval.batch_run returns them (a "messages" list each), for
+    the eval functions
+    """
+    replies = read_replies_table(path)
+    citations = {row["citation_key"]: {field: row[field] for field in CITATION_FIELDS if pd.notna(row[field])}
+                 for row in read_citations_table(path).to_dict("records")}
+    customers = dict(zip(*read_customers_table(path)[["customer_key", "data"]].to_dict("list").values()))
+
+    results = []
+    for row in replies.to_dict("records"):
+        docs = [dict(citations[key]) for key in row["citation_ids"]]
+        context = {"citations": [dict(doc) for doc in docs]}
+        inner = {"citations": docs}
+        # missing strings read back as NaN with pandas' string dtype
+        if pd.notna(row["customer_key"]):
+            customer_data = json.loads(customers[row["customer_key"]])
+            # as eval.process_test adds it
+            context["citations"].append({"id": f'customer # {customer_data["id"]}',
+                                         "title": CUSTOMER_CITATION_TITLE,
+                                         "content": str(customer_data),
+                                         "url": "don't care"})
+            inner["customer_data"] = customer_data
+        context["context"] = inner
+        if pd.notna(row["query_rewrite"]):
+            context["query_rewrite"] = row["query_rewrite"]
+        if pd.notna(row.get("extra_context")):
+            context.update(json.loads(row["extra_context"]))
+        messages = json.loads(row["history"])
+        messages.append({"role": "user", "content": row["question"]})
+        messages.append({"content": row["answer"], "role": "assistant", "context": context})
+        results.append({"messages": messages})
+    return results
+
+
+def write_eval_results(path: str, results: List[dict]):
+    """
+    writes the eval flow outputs of each reply (None for failed rows) with their pass
+    rates, in the columns concat_scores produces. results are in the order of
+    read_batch_results, they are stored under the index of their reply.
+    """
+    scores = pd.DataFrame([result or {} for result in results], dtype="float64")
+    scores.insert(0, "index", read_replies_table(path)["index"].to_numpy())
+    evaluated = pd.Series([result is not None for result in results])
+    for metric in [column for column in scores.columns if column.startswith("gpt_") and not column.endswith("_pass_rate")]:
+        if metric + "_pass_rate" not in scores:
+            # like concat_scores, a score that couldn't be parsed doesn't pass
+            scores[metric + "_pass_rate"] = (scores[metric] > 3).astype("float64").where(evaluated)
+    scores.to_parquet(os.path.join(path, EVAL_FILE), index=False)
+
+
+def aggregate_eval_results(path: str) -> dict:
+    """the metrics aggregate_variants_results logs, computed on the stored scores"""
+    scores = pd.read_parquet(os.path.join(path, EVAL_FILE)).drop(columns=["index"])
+    means = scores.mean(skipna=True)
+    return {(name + "(%)" if "pass_rate" in name else name): round(value * 100.0 if "pass_rate" in name else value, 2)
+            for name, value in means.items()}
+
+
+def benchmark(replies_file: str, rows: int = 100000):
+    """
+    file size and load time of the replies in replies_file, repeated to rows rows, as
+    JSONL and as a store
+    """
+    with open(replies_file) as f:
+        replies = [json.loads(line) for line in f]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        jsonl_file = os.path.join(tmpdir, "replies.jsonl")
+        with open(jsonl_file, "w") as f:
+            for i in range(rows):
+                f.write(json.dumps(dict(replies[i % len(replies)], index=i)) + "\n")
+        store = os.path.join(tmpdir, "replies")
+        write_reply_store(store, (dict(replies[i % len(replies)], index=i) for i in range(rows)))
+
+        # parsed line by line and dropped, pd.read_json of a large replies file runs out of memory
+        start_time = time.perf_counter()
+        with open(jsonl_file) as f:
+            for line in f:
+                json.loads(line)
+        jsonl_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        read_replies_table(store), read_citations_table(store), read_customers_table(store)
+        store_seconds = time.perf_counter() - start_time
+
+        jsonl_bytes = os.path.getsize(jsonl_file)
+        store_bytes = sum(os.path.getsize(os.path.join(store, file)) for file in os.listdir(store))
+    print(f"{rows} replies: jsonl {jsonl_bytes / 1e6:.1f} MB, parsed in {jsonl_seconds:.2f}s. "
+          f"store {store_bytes / 1e6:.1f} MB ({jsonl_bytes / store_bytes:.0f}x smaller), loaded in {store_seconds:.2f}s "
+          f"({jsonl_seconds / store_seconds:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else "data/replies.jsonl",
+              rows=int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
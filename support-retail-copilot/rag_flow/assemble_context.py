@@ -0,0 +1,110 @@
+from functools import lru_cache
+from promptflow import tool
+import tiktoken
+
+# pieces smaller than this are dropped instead of being truncated
+MIN_TRUNCATED_TOKENS = 32
+
+@lru_cache(maxsize=4)
+def get_encoding(name: str):
+    return tiktoken.get_encoding(name)
+
+def document_text(doc: dict) -> str:
+    # as rendered by customer_prompt.jinja2, the header is in title only (merge_chunks strips it from content)
+    return f"item number: {doc.get('id')}\nitem title: {doc.get('title')}\ncontent: {doc.get('content')}\n"
+
+def order_text(order: dict) -> str:
+    # as rendered by customer_prompt.jinja2
+    return "\n".join(f"{name}: {order.get(field)}" for name, field in [
+        ("order number", "id"), ("date", "date"), ("name", "name"), ("item number", "productId"),
+        ("quantity", "quantity"), ("unitprice", "unitprice"), ("total", "total"), ("description", "description")]) + "\n"
+
+def turn_text(turn: dict) -> str:
+    # as rendered by llm_call.jinja2
+    return f"user:\n{turn['inputs'].get('question')}\n\nassistant:\n{turn['outputs'].get('answer')}\n"
+
+class Budget:
+    def __init__(self, encoding, tokens: int):
+        self.encoding = encoding
+        self.remaining = tokens
+        self.used = 0
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def take(self, tokens: int) -> bool:
+        if tokens > self.remaining:
+            return False
+        self.remaining -= tokens
+        self.used += tokens
+        return True
+
+    def truncate(self, text: str, overhead: int) -> str:
+        """
+        returns the longest prefix of text that fits next to overhead tokens, or None
+        """
+        available = self.remaining - overhead
+        if available < MIN_TRUNCATED_TOKENS:
+            return None
+        truncated = self.encoding.decode(self.encoding.encode(text)[:available])
+        self.take(overhead + available)
+        return truncated
+
+@tool
+def assemble_context(question: str,
+                     documentation: list,
+                     customer: dict,
+                     chat_history: list,
+                     token_budget: int = 3000,
+                     encoding_name: str = "cl100k_base") -> dict:
+    """
+    Fits the variable parts of the prompt into token_budget tokens, by priority: the
+    current question, the top citations, the most recent orders and then the most recent
+    chat history. Whatever doesn't fit is truncated or dropped and reported under "cut".
+    The fixed text of the prompt templates is not counted.
+    """
+    budget = Budget(get_encoding(encoding_name), token_budget)
+    cut = {"citations": [], "truncated_citations": [], "orders": [],
+           "truncated_orders": [], "history_turns": 0}
+
+    # the question is always sent
+    budget.take(min(budget.count(question), budget.remaining))
+
+    docs = []
+    for doc in documentation:
+        if budget.take(budget.count(document_text(doc))):
+            docs.append(doc)
+            continue
+        content = budget.truncate(doc.get("content", ""), budget.count(document_text(dict(doc, content=""))))
+        if content is None:
+            cut["citations"].append(doc.get("id"))
+        else:
+            docs.append(dict(doc, content=content))
+            cut["truncated_citations"].append(doc.get("id"))
+
+    orders = []
+    for order in customer.get("orders", []):
+        if budget.take(budget.count(order_text(order))):
+            orders.append(order)
+            continue
+        description = budget.truncate(order.get("description", ""), budget.count(order_text(dict(order, description=""))))
+        if description is None:
+            cut["orders"].append(order.get("id"))
+        else:
+            orders.append(dict(order, description=description))
+            cut["truncated_orders"].append(order.get("id"))
+
+    # whole turns only, the most recent ones first
+    history = []
+    for turn in reversed(chat_history):
+        if not budget.take(budget.count(turn_text(turn))):
+            break
+        history.insert(0, turn)
+    cut["history_turns"] = len(chat_history) - len(history)
+    cut["tokens"] = budget.used
+    cut["token_budget"] = token_budget
+
+    return {"documentation": docs,
+            "customer": dict(customer, orders=orders),
+            "chat_history": history,
+            "cut": cut}
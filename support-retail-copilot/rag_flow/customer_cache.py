@@ -0,0 +1,113 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+
+class CustomerCache:
+    """
+    In-process read-through cache for customer profiles.
+    Entries are bounded in number (least recently used entries are evicted first)
+    and expire after a per-entry time to live.
+    """
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._watchers = {}
+
+    def get(self, key, load, ttl: float):
+        """
+        returns the cached value for key, calling load() to fill the cache on a miss.
+        callers get a copy so that they can't change what is cached.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+            if entry is not None:
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        value = load()
+        if ttl > 0:
+            with self._lock:
+                self._entries[key] = (time.monotonic() + ttl, copy.deepcopy(value))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, customer_id: str = None):
+        """
+        drops the entries for customer_id (whatever else the key contains),
+        or every entry if no customer id is given.
+        """
+        with self._lock:
+            if customer_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[-1] == customer_id]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+    def watch_change_feed(self, name, get_container, interval: float = 5.0):
+        """
+        starts (once per name) a background thread that reads the Cosmos change feed
+        of the container returned by get_container() and invalidates every customer
+        that was changed. The continuation is taken from the last response headers of
+        the container's client, so get_container() must return a container whose client
+        isn't shared with other threads.
+        """
+        with self._lock:
+            if name in self._watchers:
+                return
+            stop = threading.Event()
+            thread = threading.Thread(target=self._follow_change_feed,
+                                      args=(get_container, interval, stop),
+                                      name="customer-cache-change-feed",
+                                      daemon=True)
+            self._watchers[name] = (thread, stop)
+        thread.start()
+
+    def stop_watching(self):
+        with self._lock:
+            watchers = list(self._watchers.values())
+            self._watchers.clear()
+        for thread, stop in watchers:
+            stop.set()
+            thread.join()
+
+    def _follow_change_feed(self, get_container, interval, stop):
+        continuation = None
+        while True:
+            try:
+                container = get_container()
+                if continuation is None:
+                    changes = container.query_items_change_feed(is_start_from_beginning=False)
+                else:
+                    changes = container.query_items_change_feed(continuation=continuation)
+                for item in changes:
+                    self.invalidate(item["id"])
+                continuation = container.client_connection.last_response_headers.get("etag", continuation)
+            except Exception as e:
+                # a failing change feed only means entries live until their ttl runs out
+                print(f"customer cache change feed error: {e}")
+            if stop.wait(interval):
+                return
@@ -1,18 +1,275 @@
-from typing import Dict
+import atexit
+import json
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List
 from promptflow import tool
 from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
 from promptflow.connections import CustomConnection
+from customer_cache import CustomerCache
+
+# CosmosClient is thread-safe and meant to live for the whole process, so we keep one
+# warm client per (endpoint, database, container) instead of paying a TLS handshake and
+# metadata round trip on every chat turn.
+_containers = {}
+_containers_lock = threading.Lock()
+
+# the change feed watcher reads its continuation from its client's last response headers,
+# on the shared client those can come from a concurrent lookup, so it gets a client of its own
+_change_feed_containers = {}
+
+# every turn of a conversation looks up the same customer, so profiles are cached
+# in front of Cosmos (see customer_cache.py)
+customers = CustomerCache(max_entries=1024)
+
+# customer fields returned when only some order fields are requested
+CUSTOMER_FIELDS = ["id", "firstName", "lastName", "age", "email", "phone", "address", "membership"]
+
+def get_container(conn: CustomConnection, containers: dict = _containers):
+  key = (conn.configs["endpoint"], conn.configs["databaseId"], conn.configs["containerId"])
+  credential = conn.secrets["key"]
+  with _containers_lock:
+    entry = containers.get(key)
+    if entry is not None and entry[0] == credential:
+      return entry[2]
+    if entry is not None:
+      # the connection key was rotated, drop the client built with the old one
+      entry[1].close()
+    client = CosmosClient(url=key[0], credential=credential)
+    container = client.get_database_client(key[1]).get_container_client(key[2])
+    containers[key] = (credential, client, container)
+    return container
+
+@atexit.register
+def close_containers():
+  customers.stop_watching()
+  with _containers_lock:
+    for containers in (_containers, _change_feed_containers):
+      for _, client, _ in containers.values():
+        client.close()
+      containers.clear()
 
 # The inputs section will change based on the arguments of the tool function, after you save the code
 # Adding type to arguments and return value will help the system show the types properly
 # Please update the function name/signature per need
 @tool
-def customer_lookup(customerId: str, conn: CustomConnection) -> str:
-  client = CosmosClient(url=conn.configs["endpoint"], credential=conn.secrets["key"])
-  db = client.get_database_client(conn.configs["databaseId"])
-  container = db.get_container_client(conn.configs["containerId"])
+def customer_lookup(customerId: str, 
+                    conn: CustomConnection, 
+                    max_orders: int = 3, 
+                    order_fields: List[str] = None, 
+                    cache_ttl: int = 300, 
+                    watch_change_feed: bool = False) -> str:
+  container = get_container(conn)
+  name = (conn.configs["endpoint"], conn.configs["databaseId"], conn.configs["containerId"])
+  if watch_change_feed:
+    customers.watch_change_feed(name, lambda: get_container(conn, _change_feed_containers))
+  if order_fields:
+    load = lambda: query_customer(container, customerId, max_orders, order_fields)
+  else:
+    load = lambda: read_customer(container, customerId, max_orders)
+  key = name + (max_orders, tuple(order_fields or ()), customerId)
+  return customers.get(key, load, ttl=cache_ttl)
+
+def read_customer(container, customerId: str, max_orders: int) -> dict:
   response = container.read_item(item=customerId, partition_key=customerId)
-  orders = response["orders"]
-  orders = sorted(orders, key=lambda x: x["date"], reverse=True)
-  response["orders"] = orders[-3:]
-  return response
\ No newline at end of file
+  response["orders"] = most_recent(response["orders"], max_orders)
+  return response
+
+def query_customer(container, customerId: str, max_orders: int, order_fields: List[str]) -> dict:
+  """
+  reads only the customer fields and the order fields the flow asks for, so long order 
+  histories don't ship every order's full description over the wire.
+  """
+  # the date is always needed to pick the most recent orders
+  order_fields = list(dict.fromkeys(order_fields + ["date"]))
+  for field in CUSTOMER_FIELDS + order_fields:
+    if not field.isidentifier():
+      raise ValueError(f"invalid field name: {field}")
+  customer = ", ".join(f"c.{field}" for field in CUSTOMER_FIELDS)
+  orders = ", ".join(f"o.{field}" for field in order_fields)
+  # order dates are stored as month/day/year strings, which Cosmos can't order 
+  # chronologically, so the newest orders are picked after the projection
+  query = f"SELECT {customer}, ARRAY(SELECT {orders} FROM o IN c.orders) AS orders FROM c WHERE c.id = @id"
+  items = list(container.query_items(query=query, 
+                                     parameters=[{"name": "@id", "value": customerId}], 
+                                     partition_key=customerId))
+  if len(items) == 0:
+    raise CosmosResourceNotFoundError(status_code=404, message=f"customer {customerId} not found")
+  response = items[0]
+  response["orders"] = most_recent(response.get("orders", []), max_orders)
+  return response
+
+def most_recent(orders: list, max_orders: int) -> list:
+  return sorted(orders, key=order_date, reverse=True)[:max_orders]
+
+def order_date(order: dict) -> datetime:
+  try:
+    return datetime.strptime(order["date"], "%m/%d/%Y")
+  except (KeyError, ValueError):
+    return datetime.min
+
+def _stub_cosmos(documents: Dict[str, dict]):
+  """
+  starts a local HTTP stand-in for Cosmos that serves the account and container
+  metadata, point reads of documents (by id) and the projection query of
+  query_customer. Returns the server, which counts the connections it accepted and
+  keeps the body of the last reply, and its endpoint.
+  """
+  import re
+  from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+  projection = re.compile(r"SELECT (.*), ARRAY\(SELECT (.*) FROM o IN c\.orders\) AS orders FROM c WHERE c\.id = @id")
+
+  class StubCosmos(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, Nagle would delay every kept-alive reply
+    disable_nagle_algorithm = True
+
+    def reply(self, value, status=200):
+      body = json.dumps(value).encode("utf-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      self.server.last_reply = body
+
+    def do_GET(self):
+      path = self.path.strip("/").split("/")
+      if path == [""]:
+        endpoint = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        location = {"name": "local", "databaseAccountEndpoint": endpoint}
+        return self.reply({"id": "stub", "writableLocations": [location], "readableLocations": [location],
+                           "enableMultipleWriteLocations": False,
+                           "userConsistencyPolicy": {"defaultConsistencyLevel": "Session"}})
+      if path[-2] == "colls":
+        return self.reply({"id": path[-1], "_rid": "stub==", "partitionKey": {"paths": ["/id"], "kind": "Hash"}})
+      if path[-1] in documents:
+        return self.reply(documents[path[-1]])
+      return self.reply({"code": "NotFound", "message": "not found"}, status=404)
+
+    def do_POST(self):
+      request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+      match = projection.fullmatch(request["query"])
+      document = documents.get(request["parameters"][0]["value"])
+      if match is None or document is None:
+        return self.reply({"Documents": [], "_count": 0})
+      # like Cosmos, fields the document doesn't have are left out
+      select = lambda fields, item: {field: item[field] for field in fields if field in item}
+      customer_fields = [field[len("c."):] for field in match.group(1).split(", ")]
+      order_fields = [field[len("o."):] for field in match.group(2).split(", ")]
+      item = dict(select(customer_fields, document),
+                  orders=[select(order_fields, order) for order in document.get("orders", [])])
+      return self.reply({"Documents": [item], "_count": 1})
+
+    def log_message(self, *args):
+      pass
+
+  class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+    last_reply = b""
+
+    def get_request(self):
+      self.connections += 1
+      return super().get_request()
+
+  server = CountingServer(("127.0.0.1", 0), StubCosmos)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+def benchmark(calls: int = 200) -> dict:
+  """
+  per call latency and connections opened by calls customer reads against a local
+  stand-in for Cosmos, with a new client per call (the old tool) and the pooled container
+  """
+  import time
+  from types import SimpleNamespace
+  with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "customer_info", "customer_info_1.json")) as f:
+    customer = json.load(f)
+  server, endpoint = _stub_cosmos({str(customer["id"]): customer})
+  conn = SimpleNamespace(configs={"endpoint": endpoint, "databaseId": "contoso-outdoor", "containerId": "customers"},
+                         secrets={"key": "c3R1Yg=="})
+
+  def new_client_per_call():
+    client = CosmosClient(url=endpoint, credential=conn.secrets["key"])
+    try:
+      container = client.get_database_client(conn.configs["databaseId"]).get_container_client(conn.configs["containerId"])
+      read_customer(container, str(customer["id"]), 3)
+    finally:
+      client.close()
+
+  def pooled_container():
+    read_customer(get_container(conn), str(customer["id"]), 3)
+
+  report = {}
+  try:
+    for name, call in [("new client per call", new_client_per_call), ("pooled container", pooled_container)]:
+      before = server.connections
+      latencies = []
+      for _ in range(calls):
+        start_time = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start_time)
+      latencies.sort()
+      report[name] = {"connections": server.connections - before,
+                      "mean_ms": sum(latencies) * 1000 / calls,
+                      "p95_ms": latencies[int(0.95 * (calls - 1))] * 1000}
+      print(f"{name}: {report[name]['mean_ms']:.2f} ms per call (p95 {report[name]['p95_ms']:.2f} ms), "
+            f"{report[name]['connections']} connections for {calls} calls")
+  finally:
+    close_containers()
+    server.shutdown()
+  return report
+
+def benchmark_projection(order_counts=(10, 100, 1000), calls: int = 50,
+                         order_fields=("id", "name", "productId", "quantity", "unitprice", "total")) -> dict:
+  """
+  reply bytes, per call latency and JSON decoding time of read_customer (the whole
+  document) and query_customer (order_fields projected) for synthetic customers with
+  order_counts orders, against a local stand-in for Cosmos
+  """
+  import random
+  import time
+  from types import SimpleNamespace
+  with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "customer_info", "customer_info_1.json")) as f:
+    template = json.load(f)
+  rng = random.Random(0)
+  documents = {}
+  for count in order_counts:
+    # the orders of the sample customer, with their long descriptions, on random dates
+    orders = [dict(template["orders"][i % len(template["orders"])], id=i,
+                   date=f"{rng.randint(1, 12)}/{rng.randint(1, 28)}/{rng.randint(2015, 2023)}") for i in range(count)]
+    documents[str(count)] = dict(template, id=str(count), orders=orders)
+  server, endpoint = _stub_cosmos(documents)
+  conn = SimpleNamespace(configs={"endpoint": endpoint, "databaseId": "contoso-outdoor", "containerId": "customers"},
+                         secrets={"key": "c3R1Yg=="})
+  report = {}
+  try:
+    container = get_container(conn)
+    for count in order_counts:
+      for name, load in [("read_customer", lambda: read_customer(container, str(count), 3)),
+                         ("query_customer", lambda: query_customer(container, str(count), 3, list(order_fields)))]:
+        load()
+        body = server.last_reply
+        start_time = time.perf_counter()
+        for _ in range(calls):
+          load()
+        latency = (time.perf_counter() - start_time) / calls
+        # the SDK decodes reply bodies with json.loads
+        start_time = time.perf_counter()
+        for _ in range(calls):
+          json.loads(body)
+        decode = (time.perf_counter() - start_time) / calls
+        report[(count, name)] = {"reply_bytes": len(body), "ms_per_call": latency * 1000, "decode_ms": decode * 1000}
+        print(f"{count} orders, {name}: {len(body) / 1024:.1f} KB per reply, {latency * 1000:.2f} ms per call, "
+              f"{decode * 1000:.3f} ms to decode")
+  finally:
+    close_containers()
+    server.shutdown()
+  return report
+
+if __name__ == "__main__":
+  benchmark()
+  benchmark_projection()
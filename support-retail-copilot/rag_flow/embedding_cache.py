@@ -0,0 +1,75 @@
+"""
+A persistent embedding store shared by the question_embedding node and the indexer
+(search/init_search.py). Vectors are stored as raw float32 blobs in SQLite, keyed by
+a hash of the embedding deployment and the text, so re-embedding unchanged text
+never calls the API again.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+import numpy as np
+
+
+class EmbeddingCache:
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._db.commit()
+
+    @staticmethod
+    def key(deployment: str, text: str) -> str:
+        return hashlib.sha256(f"{deployment}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, deployment: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        returns the cached embedding of every text, None where there is none
+        """
+        keys = [self.key(deployment, text) for text in texts]
+        found = {}
+        with self._lock:
+            # stay well below SQLite's limit on query parameters
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch)
+                found.update(rows.fetchall())
+            vectors = [np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return vectors
+
+    def get(self, deployment: str, text: str) -> Optional[List[float]]:
+        return self.get_many(deployment, [text])[0]
+
+    def put_many(self, deployment: str, texts: List[str], vectors: List[List[float]]):
+        rows = [(self.key(deployment, text), np.asarray(vector, dtype=np.float32).tobytes())
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._db.commit()
+
+    def put(self, deployment: str, text: str, vector: List[float]):
+        self.put_many(deployment, [text], [vector])
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_embedding_cache(path: str) -> EmbeddingCache:
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = EmbeddingCache(path)
+        return _caches[path]
@@ -0,0 +1,137 @@
+"""
+A BM25 inverted index over the chunk content (which starts with the title), stored
+next to the local vector index so hybrid search can run offline. Postings are kept
+in flat arrays that are memory-mapped when the index is loaded:
+
+  bm25.json          vocabulary (term -> term id), average chunk length and parameters
+  bm25_offsets.i64   start of the postings of each term id, plus the end
+  bm25_docs.i32      chunk of each posting, grouped by term
+  bm25_tfs.u16       frequency of the term in that chunk
+  bm25_lengths.i32   number of terms in each chunk
+"""
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import List
+import numpy as np
+
+BM25_FILE = "bm25.json"
+OFFSETS_FILE = "bm25_offsets.i64"
+DOCS_FILE = "bm25_docs.i32"
+TFS_FILE = "bm25_tfs.u16"
+LENGTHS_FILE = "bm25_lengths.i32"
+# postings as they are added, (term id, chunk, frequency) in chunk order, removed on close
+SPILL_FILE = "bm25_postings.tmp"
+POSTING = np.dtype([("term", np.int32), ("doc", np.int32), ("tf", np.uint16)])
+
+TOKEN = re.compile(r"\w+")
+
+# the constant of reciprocal rank fusion, as used by Azure AI Search hybrid queries
+RRF_K = 60
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall((text or "").lower())
+
+
+class BM25Writer:
+    """
+    Collects the postings of chunks as they are added and writes the index on close().
+    The postings of each add() are spilled to disk, only the vocabulary and the chunk
+    lengths stay in memory.
+    """
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.vocabulary = {}
+        self.lengths = []
+        self._postings = open(os.path.join(path, SPILL_FILE), "wb")
+
+    def add(self, docs: List[dict]):
+        postings = []
+        for doc in docs:
+            terms = tokenize(doc.get("content"))
+            for term, tf in Counter(terms).items():
+                term_id = self.vocabulary.setdefault(term, len(self.vocabulary))
+                postings.append((term_id, len(self.lengths), min(tf, 65535)))
+            self.lengths.append(len(terms))
+        self._postings.write(np.asarray(postings, dtype=POSTING).tobytes())
+
+    def close(self):
+        self._postings.close()
+        spill_file = os.path.join(self.path, SPILL_FILE)
+        postings = _load(self.path, SPILL_FILE, POSTING)
+        # group by term, a stable sort keeps the chunks of each term in order
+        order = np.argsort(postings["term"], kind="stable")
+        offsets = np.zeros(len(self.vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(postings["term"], minlength=len(self.vocabulary)), out=offsets[1:])
+        offsets.tofile(os.path.join(self.path, OFFSETS_FILE))
+        postings["doc"][order].tofile(os.path.join(self.path, DOCS_FILE))
+        postings["tf"][order].tofile(os.path.join(self.path, TFS_FILE))
+        del postings, order
+        os.remove(spill_file)
+        np.asarray(self.lengths, dtype=np.int32).tofile(os.path.join(self.path, LENGTHS_FILE))
+        with open(os.path.join(self.path, BM25_FILE), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "count": len(self.lengths),
+                       "average_length": sum(self.lengths) / max(len(self.lengths), 1),
+                       "vocabulary": self.vocabulary}, f)
+
+
+def _load(path: str, file: str, dtype) -> np.ndarray:
+    # np.memmap can't map an empty file
+    if os.path.getsize(os.path.join(path, file)) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(os.path.join(path, file), dtype=dtype, mode="r")
+
+
+class BM25Index:
+    def __init__(self, path: str):
+        with open(os.path.join(path, BM25_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.k1 = meta["k1"]
+        self.b = meta["b"]
+        self.count = meta["count"]
+        self.average_length = meta["average_length"] or 1.0
+        self.vocabulary = meta["vocabulary"]
+        self.offsets = _load(path, OFFSETS_FILE, np.int64)
+        self.docs = _load(path, DOCS_FILE, np.int32)
+        self.tfs = _load(path, TFS_FILE, np.uint16)
+        self.lengths = _load(path, LENGTHS_FILE, np.int32)
+        # the length normalization of every chunk, shared by all terms
+        self.norms = (self.k1 * (1 - self.b + self.b * self.lengths / self.average_length)).astype(np.float32)
+
+    def search(self, query: str, top: int = 50):
+        """returns (indices, scores) of the top chunks for query, best first"""
+        scores = np.zeros(self.count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.docs[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            idf = math.log(1 + (self.count - (end - start) + 0.5) / ((end - start) + 0.5))
+            # a term occurs once per chunk in its postings, so the fancy index doesn't collide
+            scores[docs] += idf * tfs * (self.k1 + 1) / (tfs + self.norms[docs])
+        matches = np.flatnonzero(scores)
+        top = min(top, len(matches))
+        if top == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        best = matches[np.argpartition(-scores[matches], top - 1)[:top]]
+        best = best[np.argsort(-scores[best])]
+        return best, scores[best]
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], top: int = 6, k: int = RRF_K) -> List[int]:
+    """
+    fuses ranked lists of chunk indices, each chunk scores sum(1 / (k + rank)) over the
+    lists it appears in
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, index in enumerate(ranking):
+            scores[index] = scores.get(index, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda index: -scores[index])[:top]
@@ -0,0 +1,395 @@
+"""
+An in-process vector index over the same chunks search/init_search.py uploads to
+Azure AI Search. It is written by the indexer and lets the flow retrieve
+documentation without a network hop, e.g. for small catalogs or offline runs in CI.
+
+An index directory holds:
+  meta.json          number of documents and embedding dimensions
+  documents.jsonl    one chunk per line (id, content, title, sourcefile)
+  embeddings.f32     unit-normalized float32 embeddings, one row per chunk
+  hnsw.bin           optional HNSW graph (needs hnswlib) for larger corpora
+  compressed.bin     optional compressed copy of the embeddings for the "quantized"
+                     search mode: reduced to fewer dimensions (truncated or PCA) and/or
+                     quantized to int8 or binary. Candidates found with it are rescored
+                     with the full precision embeddings.
+  pca.npz            the PCA projection, when the compressed copy is PCA-reduced
+  bm25*              a BM25 index of the chunks for hybrid search (see lexical_index.py)
+
+The indexer builds a new index in a sibling directory and swaps it in when it is
+complete, a running flow keeps searching the files it has mapped.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from typing import List
+import numpy as np
+from lexical_index import BM25Index, BM25Writer, BM25_FILE, reciprocal_rank_fusion
+
+META_FILE = "meta.json"
+DOCUMENTS_FILE = "documents.jsonl"
+EMBEDDINGS_FILE = "embeddings.f32"
+HNSW_FILE = "hnsw.bin"
+COMPRESSED_FILE = "compressed.bin"
+PCA_FILE = "pca.npz"
+
+QUANTIZATIONS = [None, "int8", "binary"]
+REDUCTIONS = ["truncate", "pca"]
+
+# retrieve_documentation backends served by a local index, and their search mode
+BACKEND_MODES = {"local": "exact", "local_hnsw": "hnsw", "local_quantized": "quantized", "local_hybrid": "hybrid"}
+
+# candidates taken from each of the vector and BM25 rankings of a hybrid search
+HYBRID_CANDIDATES = 50
+
+# rows scanned at a time when compressing or searching compressed embeddings
+BLOCK_ROWS = 65536
+
+DOCUMENT_FIELDS = ["id", "content", "title", "sourcefile"]
+
+
+def _unit_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class LocalIndexWriter:
+    """
+    Writes a local index to the directory path a batch of chunks at a time, so the
+    indexer never holds all embeddings in memory. The index is built in build_path
+    and replaces the one at path on close().
+    """
+    def __init__(self, path: str, hnsw: bool = False, m: int = 16, ef_construction: int = 200,
+                 quantization: str = None, dimensions: int = None, reduction: str = "truncate"):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"unknown quantization: {quantization}")
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"unknown dimensionality reduction: {reduction}")
+        self.path = path
+        self.build_path = f"{os.path.normpath(path)}.tmp-{os.getpid()}"
+        # left over from a run that crashed
+        if os.path.exists(self.build_path):
+            shutil.rmtree(self.build_path)
+        os.makedirs(self.build_path)
+        self.hnsw = hnsw
+        self.quantization = quantization
+        self.reduced_dimensions = dimensions
+        self.reduction = reduction
+        self.m = m
+        self.ef_construction = ef_construction
+        self.count = 0
+        self.dimensions = None
+        self._embeddings = open(os.path.join(self.build_path, EMBEDDINGS_FILE), "wb")
+        self._documents = open(os.path.join(self.build_path, DOCUMENTS_FILE), "w", encoding="utf-8")
+        self._bm25 = BM25Writer(self.build_path)
+
+    def add(self, docs: List[dict]):
+        """adds docs (chunks with an "embedding")"""
+        if not docs:
+            return
+        embeddings = _unit_rows(np.asarray([doc["embedding"] for doc in docs], dtype=np.float32))
+        if self.dimensions is None:
+            self.dimensions = int(embeddings.shape[1])
+        self._embeddings.write(embeddings.tobytes())
+        for doc in docs:
+            self._documents.write(json.dumps({field: doc.get(field) for field in DOCUMENT_FIELDS}) + "\n")
+        self._bm25.add(docs)
+        self.count += len(docs)
+
+    def close(self, batch_size: int = 10000):
+        self._embeddings.close()
+        self._documents.close()
+        self._bm25.close()
+        if self.hnsw and self.count:
+            embeddings = np.memmap(os.path.join(self.build_path, EMBEDDINGS_FILE), dtype=np.float32,
+                                   mode="r", shape=(self.count, self.dimensions))
+            graph = _new_hnsw(self.dimensions)
+            graph.init_index(max_elements=self.count, M=self.m, ef_construction=self.ef_construction)
+            for start in range(0, self.count, batch_size):
+                end = min(start + batch_size, self.count)
+                graph.add_items(np.asarray(embeddings[start:end]), np.arange(start, end))
+            graph.save_index(os.path.join(self.build_path, HNSW_FILE))
+        meta = {"count": self.count, "dimensions": self.dimensions or 0}
+        if (self.quantization or self.reduced_dimensions) and self.count:
+            meta["compression"] = self._compress()
+        with open(os.path.join(self.build_path, META_FILE), "w") as f:
+            json.dump(meta, f)
+        _swap(self.build_path, self.path)
+
+    def _compress(self) -> dict:
+        embeddings = np.memmap(os.path.join(self.build_path, EMBEDDINGS_FILE), dtype=np.float32,
+                               mode="r", shape=(self.count, self.dimensions))
+        compression = {"quantization": self.quantization,
+                       "dimensions": min(self.reduced_dimensions or self.dimensions, self.dimensions),
+                       "reduction": self.reduction if self.reduced_dimensions else None}
+        if compression["reduction"] == "pca":
+            # fit on a sample, the principal directions of a corpus settle quickly
+            sample = embeddings[np.sort(np.random.default_rng(0).choice(
+                self.count, size=min(self.count, 20000), replace=False))]
+            mean = sample.mean(axis=0)
+            _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+            components = vt[:compression["dimensions"]]
+            compression["dimensions"] = int(components.shape[0])
+            np.savez(os.path.join(self.build_path, PCA_FILE), mean=mean, components=components)
+        compressor = Compressor(compression, self.build_path)
+
+        if self.quantization == "int8":
+            # one symmetric scale for all dimensions, from the largest reduced component
+            peak = max(float(np.abs(compressor.reduce(embeddings[start:start + BLOCK_ROWS])).max())
+                       for start in range(0, self.count, BLOCK_ROWS))
+            compression["scale"] = 127.0 / (peak or 1.0)
+            compressor = Compressor(compression, self.build_path)
+
+        with open(os.path.join(self.build_path, COMPRESSED_FILE), "wb") as f:
+            for start in range(0, self.count, BLOCK_ROWS):
+                f.write(compressor.encode(embeddings[start:start + BLOCK_ROWS]).tobytes())
+        return compression
+
+
+def _swap(build_path: str, path: str):
+    """
+    moves the index built in build_path to path. Files of the old index are never
+    truncated, readers that mapped them keep them until they reload, path is only
+    missing between the two renames.
+    """
+    old_path = None
+    if os.path.exists(path):
+        old_path = f"{os.path.normpath(path)}.old-{os.getpid()}"
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        os.rename(path, old_path)
+    os.rename(build_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+class Compressor:
+    """
+    Reduces and quantizes unit embeddings as described by the "compression" entry of
+    meta.json, and scores queries against the compressed rows.
+    """
+    def __init__(self, compression: dict, path: str):
+        self.quantization = compression["quantization"]
+        self.dimensions = compression["dimensions"]
+        self.reduction = compression["reduction"]
+        self.scale = compression.get("scale", 1.0)
+        self.pca = None
+        if self.reduction == "pca":
+            with np.load(os.path.join(path, PCA_FILE)) as pca:
+                self.pca = (pca["mean"], pca["components"])
+
+    def reduce(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.pca is not None:
+            mean, components = self.pca
+            vectors = (vectors - mean) @ components.T
+        else:
+            vectors = vectors[:, :self.dimensions]
+        return _unit_rows(vectors)
+
+    @property
+    def row_dtype(self):
+        return {"int8": np.int8, "binary": np.uint8}.get(self.quantization, np.float32)
+
+    @property
+    def row_width(self) -> int:
+        return (self.dimensions + 7) // 8 if self.quantization == "binary" else self.dimensions
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.row_width * np.dtype(self.row_dtype).itemsize
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        reduced = self.reduce(vectors)
+        if self.quantization == "int8":
+            return np.clip(np.rint(reduced * self.scale), -127, 127).astype(np.int8)
+        if self.quantization == "binary":
+            return np.packbits(reduced > 0, axis=1)
+        return reduced
+
+    def decode(self, rows: np.ndarray) -> np.ndarray:
+        if self.quantization == "int8":
+            return rows.astype(np.float32)
+        if self.quantization == "binary":
+            # bits as +1/-1, scored against the unquantized query
+            return np.unpackbits(rows, axis=1, count=self.dimensions).astype(np.float32) * 2 - 1
+        return rows
+
+
+def write_local_index(path: str, docs: List[dict], hnsw: bool = False, m: int = 16, ef_construction: int = 200,
+                      quantization: str = None, dimensions: int = None, reduction: str = "truncate"):
+    """
+    writes docs (chunks with an "embedding") as a local index to the directory path
+    """
+    writer = LocalIndexWriter(path, hnsw=hnsw, m=m, ef_construction=ef_construction,
+                              quantization=quantization, dimensions=dimensions, reduction=reduction)
+    writer.add(docs)
+    writer.close()
+
+
+def _new_hnsw(dimensions: int):
+    try:
+        import hnswlib
+    except ImportError:
+        raise ImportError("the HNSW mode of the local index needs hnswlib, install it with 'pip install hnswlib'")
+    return hnswlib.Index(space="ip", dim=dimensions)
+
+
+def _top(scores: np.ndarray, top: int):
+    """the column indices and values of the top largest scores of each row, best first"""
+    indices = np.argpartition(-scores, top - 1, axis=1)[:, :top]
+    top_scores = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-top_scores, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _map(path: str, dtype, shape) -> np.ndarray:
+    # np.memmap can't map an empty file
+    if shape[0] == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+class LocalIndex:
+    def __init__(self, path: str):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.path = path
+        self.count = meta["count"]
+        self.dimensions = meta["dimensions"]
+        self.embeddings = _map(os.path.join(path, EMBEDDINGS_FILE), np.float32, (self.count, self.dimensions))
+        with open(os.path.join(path, DOCUMENTS_FILE), encoding="utf-8") as f:
+            self.documents = [json.loads(line) for line in f]
+        self.hnsw = None
+        if os.path.exists(os.path.join(path, HNSW_FILE)):
+            self.hnsw = _new_hnsw(self.dimensions)
+            self.hnsw.load_index(os.path.join(path, HNSW_FILE), max_elements=self.count)
+        self.bm25 = BM25Index(path) if os.path.exists(os.path.join(path, BM25_FILE)) else None
+        self.compressor = None
+        self.compressed = None
+        if "compression" in meta:
+            self.compressor = Compressor(meta["compression"], path)
+            self.compressed = _map(os.path.join(path, COMPRESSED_FILE), self.compressor.row_dtype,
+                                   (self.count, self.compressor.row_width))
+
+    def search(self, queries, top: int = 6, mode: str = "exact", ef: int = 100, oversampling: int = 4):
+        """
+        returns (indices, scores), each of shape (len(queries), top), best first.
+        mode is "exact" for a brute force scan, "hnsw" for the HNSW graph or "quantized"
+        for a scan of the compressed embeddings, whose top * oversampling candidates
+        are rescored with the full precision embeddings.
+        """
+        queries = _unit_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        top = min(top, self.count)
+        if top == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        if mode == "hnsw":
+            if self.hnsw is None:
+                raise ValueError(f"local index {self.path} was built without an HNSW graph")
+            self.hnsw.set_ef(max(ef, top))
+            indices, distances = self.hnsw.knn_query(queries, k=top)
+            return indices.astype(np.int64), 1.0 - distances
+        if mode == "quantized":
+            if self.compressor is None:
+                raise ValueError(f"local index {self.path} was built without compressed embeddings")
+            candidates = min(top * oversampling, self.count)
+            reduced = self.compressor.reduce(queries)
+            scores = np.concatenate([reduced @ self.compressor.decode(self.compressed[start:start + BLOCK_ROWS]).T
+                                     for start in range(0, self.count, BLOCK_ROWS)], axis=1)
+            indices, _ = _top(scores, candidates)
+            # rescore the candidates with the full precision embeddings
+            rescored = np.stack([self.embeddings[row] @ query for row, query in zip(indices, queries)])
+            best, top_scores = _top(rescored, top)
+            return np.take_along_axis(indices, best, axis=1), top_scores
+        if mode != "exact":
+            raise ValueError(f"unknown local index search mode: {mode}")
+        return _top(queries @ self.embeddings.T, top)
+
+    def bytes_per_vector(self, mode: str = "exact") -> int:
+        """bytes of the vectors a search in mode scans, per chunk"""
+        if mode == "quantized" and self.compressor is not None:
+            return self.compressor.bytes_per_vector
+        return self.dimensions * 4
+
+    def hybrid_search(self, question: str, embedding: List[float], top: int = 6,
+                      candidates: int = HYBRID_CANDIDATES) -> List[int]:
+        """
+        fuses the BM25 ranking for question and the vector ranking for embedding (from
+        the HNSW graph when there is one) by reciprocal rank fusion, like the hybrid
+        queries of Azure AI Search
+        """
+        if self.bm25 is None:
+            raise ValueError(f"local index {self.path} was built without a BM25 index")
+        vector, _ = self.search([embedding], top=candidates, mode="hnsw" if self.hnsw is not None else "exact")
+        lexical, _ = self.bm25.search(question, top=candidates)
+        return reciprocal_rank_fusion([vector[0].tolist(), lexical.tolist()], top=top)
+
+    def retrieve(self, embedding: List[float], top: int = 6, mode: str = "exact", question: str = None) -> List[dict]:
+        """
+        returns the top documents for a single query embedding in the shape of the
+        retrieve_documentation tool, mode "hybrid" also needs the question
+        """
+        if mode == "hybrid":
+            return [dict(self.documents[i]) for i in self.hybrid_search(question, embedding, top=top)]
+        indices, _ = self.search([embedding], top=top, mode=mode)
+        return [dict(self.documents[i]) for i in indices[0]]
+
+
+def recall_at_k(index: LocalIndex, queries, k: int = 6, mode: str = "hnsw", **search_args) -> float:
+    """
+    fraction of the exact top k neighbours that a search in mode also returns
+    """
+    exact, _ = index.search(queries, top=k, mode="exact")
+    approximate, _ = index.search(queries, top=k, mode=mode, **search_args)
+    found = sum(len(set(e) & set(a)) for e, a in zip(exact.tolist(), approximate.tolist()))
+    return found / exact.size
+
+
+def benchmark(index: LocalIndex, queries, k_values=(1, 3, 6, 10), modes=("exact", "hnsw", "quantized")) -> List[dict]:
+    """
+    recall@k against exhaustive search, bytes per vector and latency of single-query
+    searches, for each search mode the index supports
+    """
+    report = []
+    for mode in modes:
+        if (mode == "hnsw" and index.hnsw is None) or (mode == "quantized" and index.compressor is None):
+            continue
+        start_time = time.perf_counter()
+        for query in queries:
+            index.search([query], top=max(k_values), mode=mode)
+        row = {"mode": mode,
+               "bytes_per_vector": index.bytes_per_vector(mode),
+               "ms_per_query": (time.perf_counter() - start_time) * 1000 / max(len(queries), 1)}
+        for k in k_values:
+            row[f"recall@{k}"] = recall_at_k(index, queries, k=k, mode=mode)
+        report.append(row)
+    return report
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_local_index(path: str) -> LocalIndex:
+    """
+    returns the loaded index at path, reloading it when the indexer rewrote it
+    """
+    path = os.path.abspath(path)
+    try:
+        stat = os.stat(os.path.join(path, META_FILE))
+    except FileNotFoundError:
+        # the indexer is swapping in a new index, keep serving the loaded one
+        with _indexes_lock:
+            entry = _indexes.get(path)
+        if entry is None:
+            raise
+        return entry[1]
+    # a swapped in index is a new file, even within the mtime resolution
+    version = (stat.st_ino, stat.st_mtime_ns)
+    with _indexes_lock:
+        entry = _indexes.get(path)
+        if entry is None or entry[0] != version:
+            entry = (version, LocalIndex(path))
+            _indexes[path] = entry
+        return entry[1]
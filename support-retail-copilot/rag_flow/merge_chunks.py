@@ -0,0 +1,70 @@
+import re
+from promptflow import tool
+
+# init_search.py splits with chunk_overlap=100, leave some room for separators
+MAX_OVERLAP = 300
+MIN_OVERLAP = 20
+GAP = "\n\n...\n\n"
+
+# joins adjacent chunks the splitter cut at a paragraph break, without overlap
+PARAGRAPH = "\n\n"
+
+def id_position(doc: dict):
+    # chunk ids end with their position (a running number or <sourcefile>-<n>)
+    match = re.search(r"(\d+)$", str(doc["id"]))
+    return int(match.group(1)) if match else None
+
+def chunk_position(doc: dict, rank: int):
+    position = id_position(doc)
+    return (rank if position is None else position, rank)
+
+def strip_header(doc: dict) -> str:
+    content, title = doc.get("content", ""), doc.get("title") or ""
+    return content[len(title):] if title and content.startswith(title) else content
+
+def overlap(a: str, b: str) -> int:
+    """
+    length of the longest suffix of a that is also a prefix of b
+    """
+    for size in range(min(len(a), len(b), MAX_OVERLAP), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+@tool
+def merge_chunks(documentation: list) -> list:
+    """
+    Groups retrieved chunks by source file and stitches them into one document per file.
+    Chunks at consecutive positions are adjacent: they are joined, dropping the text they
+    overlap on, if any. Only between chunks that aren't adjacent a GAP marks the text that
+    was left out. The header every chunk starts with is kept only in "title" (the prompt
+    renders it from there), content is the body. The merged document keeps the ids of
+    all its chunks (comma separated) and the position of its best ranked chunk.
+    """
+    groups = {}
+    for rank, doc in enumerate(documentation):
+        key = doc.get("sourcefile") or f"id:{doc['id']}"
+        groups.setdefault(key, []).append((rank, doc))
+
+    merged = []
+    for chunks in groups.values():
+        if len(chunks) == 1:
+            merged.append(dict(chunks[0][1], content=strip_header(chunks[0][1])))
+            continue
+        chunks = sorted(chunks, key=lambda chunk: chunk_position(chunk[1], chunk[0]))
+        first = chunks[0][1]
+        body = strip_header(first)
+        previous = id_position(first)
+        for _, doc in chunks[1:]:
+            text = strip_header(doc)
+            position = id_position(doc)
+            if previous is not None and position == previous + 1:
+                size = overlap(body, text)
+                body += text[size:] if size else PARAGRAPH + text
+            else:
+                body += GAP + text
+            previous = position
+        merged.append(dict(first,
+                           id=", ".join(str(doc["id"]) for _, doc in chunks),
+                           content=body))
+    return merged
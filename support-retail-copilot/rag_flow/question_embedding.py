@@ -0,0 +1,29 @@
+from typing import List
+from promptflow import tool
+from promptflow.connections import AzureOpenAIConnection
+from aoai_clients import get_aoai_client
+from embedding_cache import get_embedding_cache
+
+@tool
+def question_embedding(input: str, 
+                       connection: AzureOpenAIConnection, 
+                       deployment_name: str, 
+                       cache_path: str = "") -> List[float]:
+    """
+    embeds the (rewritten) question, looking it up in the persistent embedding cache
+    first when a cache_path is given
+    """
+    cache = get_embedding_cache(cache_path) if cache_path else None
+    if cache is not None:
+        embedding = cache.get(deployment_name, input)
+        if embedding is not None:
+            return embedding
+
+    embedding = get_aoai_client(connection).embeddings.create(
+        model=deployment_name,
+        input=input
+    ).data[0].embedding
+
+    if cache is not None:
+        cache.put(deployment_name, input, embedding)
+    return embedding
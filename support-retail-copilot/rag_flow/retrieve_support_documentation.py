@@ -1,35 +1,77 @@
+import time
 from typing import List
 from promptflow import tool
-from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizedQuery, QueryType, QueryCaptionType, QueryAnswerType
-from azure.core.credentials import AzureKeyCredential
 from promptflow.connections import CognitiveSearchConnection
+from search_clients import get_search_client, get_index_client, search_arguments
+from semantic_cache import retrieval_cache, INDEX_CHECK_INTERVAL
+from local_index import get_local_index, BACKEND_MODES
+import speculation
 
 @tool
-def retrieve_documentation(question: str, index_name: str, embedding: List[float], search: CognitiveSearchConnection) -> str:
+def retrieve_documentation(question: str, 
+                           index_name: str, 
+                           embedding: List[float], 
+                           search: CognitiveSearchConnection,
+                           semantic_cache: bool = False,
+                           cache_distance: float = 0.01,
+                           backend: str = "azure",
+                           local_index_path: str = "../data/local_index",
+                           speculative_docs: list = None,
+                           speculative_embedding: List[float] = None,
+                           keep_similarity: float = 0.97,
+                           merge_similarity: float = 0.9) -> str:
+
+  decision = None
+  if speculative_docs is not None and speculative_embedding is not None:
+    # results retrieved for the raw question while the query was being rewritten
+    decision = speculation.decide(embedding, speculative_embedding, keep_similarity, merge_similarity)
+    if decision == speculation.KEEP:
+      return speculative_docs
+
+  docs = search_documentation(question, index_name, embedding, search, 
+                              semantic_cache, cache_distance, backend, local_index_path)
+
+  if decision == speculation.MERGE:
+    return speculation.merge(docs, speculative_docs, top=6)
+  return docs
+
+def search_documentation(question: str, 
+                         index_name: str, 
+                         embedding: List[float], 
+                         search: CognitiveSearchConnection,
+                         semantic_cache: bool,
+                         cache_distance: float,
+                         backend: str,
+                         local_index_path: str) -> list:
+
+  if backend in BACKEND_MODES:
+    # in-process index written by search/init_search.py --local-index
+    index = get_local_index(local_index_path)
+    return index.retrieve(embedding, top=6, mode=BACKEND_MODES[backend], question=question)
+
+  if semantic_cache:
+    # drop cached results once the index was rebuilt by search/init_search.py
+    if retrieval_cache.version_check_due(index_name, INDEX_CHECK_INTERVAL):
+      index = get_index_client(search.api_base, search.api_key).get_index(index_name)
+      retrieval_cache.set_version(index_name, index.e_tag)
+    docs = retrieval_cache.get(index_name, embedding, max_distance=cache_distance)
+    if docs is not None:
+      return docs
 
   # Semantic Hybrid Search
   query = question
+  start_time = time.perf_counter()
+
+  search_client = get_search_client(search.api_base, index_name, search.api_key)
 
-  search_client = SearchClient(endpoint=search.api_base, 
-                              index_name=index_name, 
-                              credential=AzureKeyCredential(search.api_key))
-
-  vector_query = VectorizedQuery(vector=embedding, 
-                                 k_nearest_neighbors=3, 
-                                 fields="embedding")
-
-  results = search_client.search(  
-      search_text=query,  
-      vector_queries=[vector_query],
-      query_type=QueryType.SEMANTIC, 
-      semantic_configuration_name='default', 
-      query_caption=QueryCaptionType.EXTRACTIVE, 
-      query_answer=QueryAnswerType.EXTRACTIVE,
-      top=6
-  )
-
-  docs = [{"id": doc["id"],  "content": doc["content"]}
+  results = search_client.search(**search_arguments(query, embedding, top=6))
+
+  docs = [{"id": doc["id"],  "content": doc["content"], "title": doc.get("title"), "sourcefile": doc.get("sourcefile")}
           for doc in results]
+
+  latency = time.perf_counter() - start_time
+  speculation.speculation_stats.record_search(latency)
+  if semantic_cache:
+    retrieval_cache.put(index_name, embedding, docs, latency)
   
   return docs
\ No newline at end of file
@@ -1,25 +1,52 @@
 from promptflow import tool
 from promptflow.connections import AzureOpenAIConnection
-import os, openai
+import os, re
+from functools import lru_cache
 from jinja2 import Template
+from aoai_clients import get_aoai_client
+import llm_cache
+
+jinja_template = os.path.join(os.path.dirname(__file__), "rewrite_query.jinja2")
+
+# words that refer back to something said earlier in the conversation
+REFERENCES = re.compile(r"\b(it|its|it's|they|them|their|this|that|these|those|one|ones|same|above|previous|earlier)\b", re.IGNORECASE)
+
+@lru_cache(maxsize=8)
+def load_template(path: str, mtime: float) -> Template:
+    # keyed on the modification time so edits to the template are picked up
+    with open(path, encoding="utf-8") as f:
+        return Template(f.read())
+
+def should_bypass(query: str, chat_history: list, bypass: str) -> bool:
+    """
+    bypass policies:
+      never          - always rewrite the query
+      first_turn     - skip the rewrite when there is no chat history
+      self_contained - also skip it when the query doesn't refer back to the conversation
+    """
+    if bypass == "never":
+        return False
+    if bypass == "first_turn":
+        return len(chat_history) == 0
+    if bypass == "self_contained":
+        return len(chat_history) == 0 or REFERENCES.search(query) is None
+    raise ValueError(f"unknown rewrite bypass policy: {bypass}")
 
 @tool
-def rewrite_query(query: str, 
-                  chat_history: list[str], 
-                  customer_data: dict, 
+def rewrite_query(query: str,
+                  chat_history: list[str],
+                  customer_data: dict,
                   azure_open_ai_connection: AzureOpenAIConnection,
-                  open_ai_deployment: str) -> str:
+                  open_ai_deployment: str,
+                  bypass: str = "never") -> str:
     """
     rewrite the query based on the chat history and customer data
     """
-    aoai_client = openai.AzureOpenAI(
-        api_key = azure_open_ai_connection.api_key,  
-        api_version = azure_open_ai_connection.api_version,
-        azure_endpoint = azure_open_ai_connection.api_base 
-    )
-    jinja_template = os.path.join(os.path.dirname(__file__), "rewrite_query.jinja2")
-    with open(jinja_template, encoding="utf-8") as f:
-        template = Template(f.read())
+    if should_bypass(query, chat_history, bypass):
+        return query
+
+    aoai_client = get_aoai_client(azure_open_ai_connection)
+    template = load_template(jinja_template, os.path.getmtime(jinja_template))
     prompt = template.render(query=query, chat_history=chat_history, customer_data=customer_data)
     messages = [
         {
@@ -28,13 +55,13 @@ def rewrite_query(query: str,
         }
     ]
 
-    chat_intent_completion = aoai_client.chat.completions.create(
-        model=open_ai_deployment,
-        messages=messages,
+    user_intent = llm_cache.chat_completion(
+        aoai_client,
+        open_ai_deployment,
+        messages,
         temperature=0,
         max_tokens=1024,
         n=1,
     )
-    user_intent = chat_intent_completion.choices[0].message.content
 
-    return user_intent
\ No newline at end of file
+    return user_intent
@@ -0,0 +1,150 @@
+import atexit
+import threading
+from typing import List
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.search.documents.indexes import SearchIndexClient
+from azure.search.documents.models import VectorizedQuery, QueryType, QueryCaptionType, QueryAnswerType
+
+# Search clients keep their HTTP connection pool open, so we reuse one client per
+# (endpoint, index) instead of opening new sockets for every question. Index clients
+# are cached under (endpoint, None). Async clients are not cached: promptflow runs
+# each async tool call on a new event loop, and a client can't outlive its loop.
+_clients = {}
+_lock = threading.Lock()
+
+def _credential(clients: dict, key: tuple, api_key: str):
+    """
+    returns the cached client for key if there is one, rotating its key if needed
+    """
+    entry = clients.get(key)
+    if entry is None:
+        return None
+    credential, client = entry
+    if credential.key != api_key:
+        credential.update(api_key)
+    return client
+
+def get_search_client(endpoint: str, index_name: str, api_key: str) -> SearchClient:
+    key = (endpoint, index_name)
+    with _lock:
+        client = _credential(_clients, key, api_key)
+        if client is None:
+            credential = AzureKeyCredential(api_key)
+            client = SearchClient(endpoint=endpoint, index_name=index_name, credential=credential)
+            _clients[key] = (credential, client)
+        return client
+
+def get_index_client(endpoint: str, api_key: str) -> SearchIndexClient:
+    key = (endpoint, None)
+    with _lock:
+        client = _credential(_clients, key, api_key)
+        if client is None:
+            credential = AzureKeyCredential(api_key)
+            client = SearchIndexClient(endpoint=endpoint, credential=credential)
+            _clients[key] = (credential, client)
+        return client
+
+@atexit.register
+def close_search_clients():
+    with _lock:
+        for _, client in _clients.values():
+            client.close()
+        _clients.clear()
+
+def search_arguments(question: str, embedding: List[float], top: int = 6) -> dict:
+    """
+    arguments for a semantic hybrid search, shared by the sync and async tools
+    """
+    vector_query = VectorizedQuery(vector=embedding, 
+                                   k_nearest_neighbors=3, 
+                                   fields="embedding")
+    return dict(
+        search_text=question,
+        vector_queries=[vector_query],
+        query_type=QueryType.SEMANTIC, 
+        semantic_configuration_name='default', 
+        query_caption=QueryCaptionType.EXTRACTIVE, 
+        query_answer=QueryAnswerType.EXTRACTIVE,
+        top=top
+    )
+
+
+def benchmark(queries: int = 1000) -> dict:
+    """
+    sockets opened and seconds taken by queries searches against a local stub of the
+    search service, with a new client per search (the old tool), the pooled client and
+    the async tool's client opened per call
+    """
+    import asyncio
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+    class StubSearch(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are separate writes, Nagle would delay every kept-alive reply
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.dumps({"value": [{"@search.score": 1.0, "id": "1", "content": "stub"}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class CountingServer(ThreadingHTTPServer):
+        daemon_threads = True
+        connections = 0
+
+        def get_request(self):
+            self.connections += 1
+            return super().get_request()
+
+    server = CountingServer(("127.0.0.1", 0), StubSearch)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    embedding = [0.0] * 1536
+
+    def new_client_per_query():
+        for i in range(queries):
+            with SearchClient(endpoint=endpoint, index_name="stub", credential=AzureKeyCredential("key")) as client:
+                list(client.search(**search_arguments(f"question {i}", embedding)))
+
+    def pooled_client():
+        for i in range(queries):
+            client = get_search_client(endpoint, "stub", "key")
+            list(client.search(**search_arguments(f"question {i}", embedding)))
+
+    def async_client_per_call():
+        async def search(i):
+            async with AsyncSearchClient(endpoint=endpoint, index_name="stub", credential=AzureKeyCredential("key")) as client:
+                return [doc async for doc in await client.search(**search_arguments(f"question {i}", embedding))]
+        for i in range(queries):
+            # a new event loop per call, like promptflow runs async tools
+            asyncio.run(search(i))
+
+    report = {}
+    try:
+        for name, run in [("new client per query", new_client_per_query),
+                          ("pooled client", pooled_client),
+                          ("async client per call", async_client_per_call)]:
+            before = server.connections
+            start_time = time.perf_counter()
+            run()
+            report[name] = {"sockets": server.connections - before, "seconds": time.perf_counter() - start_time}
+            print(f"{name}: {report[name]['sockets']} sockets, {report[name]['seconds']:.2f}s for {queries} searches")
+    finally:
+        close_search_clients()
+        server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+import numpy as np
+
+
+class _IndexEntries:
+    """
+    cached queries of one search index. query embeddings are kept as unit vectors in
+    the rows of a preallocated matrix so a lookup is a single matrix-vector product.
+    """
+    def __init__(self, capacity: int, dimensions: int):
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.used = np.zeros(capacity, dtype=bool)
+        self.results = {}
+        self.lru = OrderedDict()
+        self.free = list(range(capacity - 1, -1, -1))
+        self.version = None
+        self.checked_at = 0.0
+
+
+class SemanticCache:
+    """
+    Approximate result cache for retrieval. A query hits when its embedding is within
+    max_distance (cosine distance) of a cached query against the same index. ada-002
+    similarities cluster high, questions that only differ in a product name can be
+    within 0.05 of each other, so keep max_distance tight.
+    """
+    def __init__(self,
+                 max_distance: float = 0.01,
+                 max_entries: int = 512,
+                 max_bytes: int = 64 * 1024 * 1024):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self._bytes = 0
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    @staticmethod
+    def _size(vector: np.ndarray, docs: list) -> int:
+        return vector.nbytes + sum(len(str(value)) for doc in docs for value in doc.values())
+
+    def get(self, index_name: str, embedding: List[float], max_distance: float = None):
+        """
+        returns the cached results of the nearest cached query, or None
+        """
+        max_distance = self.max_distance if max_distance is None else max_distance
+        query = self._unit(embedding)
+        with self._lock:
+            entries = self._indexes.get(index_name)
+            if entries is None or not entries.lru or entries.vectors.shape[1] != query.shape[0]:
+                self.misses += 1
+                return None
+            similarities = entries.vectors @ query
+            similarities[~entries.used] = -np.inf
+            slot = int(np.argmax(similarities))
+            if 1.0 - similarities[slot] > max_distance:
+                self.misses += 1
+                return None
+            entries.lru.move_to_end(slot)
+            docs, latency, _ = entries.results[slot]
+            self.hits += 1
+            self.saved_seconds += latency
+            return [dict(doc) for doc in docs]
+
+    def put(self, index_name: str, embedding: List[float], docs: list, latency: float):
+        """
+        caches docs for the query embedding, latency is how long the search took
+        """
+        vector = self._unit(embedding)
+        size = self._size(vector, docs)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            entries = self._indexes.get(index_name)
+            if entries is None or entries.vectors.shape[1] != vector.shape[0]:
+                if entries is not None:
+                    self._drop(entries)
+                entries = _IndexEntries(self.max_entries, vector.shape[0])
+                self._indexes[index_name] = entries
+            while not entries.free or self._bytes + size > self.max_bytes:
+                if not self._evict(entries):
+                    return
+            slot = entries.free.pop()
+            entries.vectors[slot] = vector
+            entries.used[slot] = True
+            entries.results[slot] = ([dict(doc) for doc in docs], latency, size)
+            entries.lru[slot] = None
+            self._bytes += size
+
+    def _evict(self, entries: _IndexEntries) -> bool:
+        """
+        evicts the least recently used entry, preferring the index being written to
+        """
+        if not entries.lru:
+            others = [other for other in self._indexes.values() if other.lru]
+            if not others:
+                return False
+            entries = others[0]
+        slot, _ = entries.lru.popitem(last=False)
+        self._release(entries, slot)
+        self.evictions += 1
+        return True
+
+    def _release(self, entries: _IndexEntries, slot: int):
+        entries.used[slot] = False
+        self._bytes -= entries.results.pop(slot)[2]
+        entries.free.append(slot)
+
+    def _drop(self, entries: _IndexEntries):
+        for slot in list(entries.lru):
+            self._release(entries, slot)
+        entries.lru.clear()
+
+    def invalidate(self, index_name: str = None):
+        """
+        drops the cached queries of index_name, or of every index
+        """
+        with self._lock:
+            names = list(self._indexes) if index_name is None else [index_name]
+            for name in names:
+                entries = self._indexes.pop(name, None)
+                if entries is not None:
+                    self._drop(entries)
+
+    def version_check_due(self, index_name: str, interval: float) -> bool:
+        with self._lock:
+            entries = self._indexes.get(index_name)
+            return entries is not None and time.monotonic() - entries.checked_at >= interval
+
+    def set_version(self, index_name: str, version: str):
+        """
+        records the current version (etag) of the index, dropping its cached queries
+        if the index was rebuilt since they were cached
+        """
+        with self._lock:
+            entries = self._indexes.get(index_name)
+            if entries is None:
+                return
+            entries.checked_at = time.monotonic()
+            if entries.version is None:
+                entries.version = version
+            elif entries.version != version:
+                self._drop(entries)
+                entries.version = version
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": sum(len(entries.lru) for entries in self._indexes.values()),
+                    "bytes": self._bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "saved_seconds": self.saved_seconds}
+
+
+# shared by the sync and async retrieval tools
+retrieval_cache = SemanticCache()
+
+# how often (in seconds) to check whether a cached index was rebuilt
+INDEX_CHECK_INTERVAL = 60
@@ -0,0 +1,75 @@
+"""
+Speculative retrieval: the flow retrieves documentation for the raw question while
+the query is being rewritten. Once the rewritten query is embedded, the speculative
+results are kept (the queries are near-identical, no second search), merged with the
+results for the rewritten query, or discarded. Decisions and the search time they
+saved are counted in speculation_stats, read them with speculation_stats.stats(). The
+flow returns them as its speculation output (see speculation_report.py), and
+exp/eval.py prints them after a batch run.
+"""
+import threading
+from typing import List
+import numpy as np
+
+KEEP = "keep"
+MERGE = "merge"
+DISCARD = "discard"
+
+
+class SpeculationStats:
+    def __init__(self):
+        self.decisions = {KEEP: 0, MERGE: 0, DISCARD: 0}
+        self.searches = 0
+        self.search_seconds = 0.0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_search(self, seconds: float):
+        with self._lock:
+            self.searches += 1
+            self.search_seconds += seconds
+
+    def record(self, decision: str):
+        with self._lock:
+            self.decisions[decision] += 1
+            if decision == KEEP and self.searches:
+                # a kept speculation saves the search on the critical path
+                self.saved_seconds += self.search_seconds / self.searches
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self.decisions.values())
+            used = self.decisions[KEEP] + self.decisions[MERGE]
+            return dict(self.decisions,
+                        used_rate=used / total if total else 0.0,
+                        saved_seconds=self.saved_seconds)
+
+
+speculation_stats = SpeculationStats()
+
+
+def decide(embedding: List[float], speculative_embedding: List[float], keep_similarity: float, merge_similarity: float) -> str:
+    a = np.asarray(embedding, dtype=np.float32)
+    b = np.asarray(speculative_embedding, dtype=np.float32)
+    similarity = float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) or 1.0))
+    if similarity >= keep_similarity:
+        decision = KEEP
+    elif similarity >= merge_similarity:
+        decision = MERGE
+    else:
+        decision = DISCARD
+    speculation_stats.record(decision)
+    return decision
+
+
+def merge(docs: List[dict], speculative_docs: List[dict], top: int = 6) -> List[dict]:
+    """
+    interleaves both result lists (rewritten query first), dropping duplicates
+    """
+    merged, seen = [], set()
+    for i in range(max(len(docs), len(speculative_docs))):
+        for results in (docs, speculative_docs):
+            if i < len(results) and results[i]["id"] not in seen:
+                seen.add(results[i]["id"])
+                merged.append(results[i])
+    return merged[:top]
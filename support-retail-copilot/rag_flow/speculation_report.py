@@ -0,0 +1,10 @@
+from promptflow import tool
+import speculation
+
+@tool
+def speculation_report(documentation: list) -> dict:
+  """
+  the speculative retrieval decisions of this process so far and the search time they
+  saved. documentation only orders the node after the retrieval it reports on.
+  """
+  return speculation.speculation_stats.stats()
\ No newline at end of file
@@ -1,16 +1,44 @@
+import atexit
+import threading
 from typing import Dict
 from promptflow import tool
 from azure.cosmos import CosmosClient
 from promptflow.connections import CustomConnection
 
+# CosmosClient is thread-safe and meant to live for the whole process, so we keep one
+# warm client per (endpoint, database, container) instead of paying a TLS handshake and
+# metadata round trip on every chat turn.
+_containers = {}
+_containers_lock = threading.Lock()
+
+def get_container(conn: CustomConnection):
+  key = (conn.configs["endpoint"], conn.configs["databaseId"], conn.configs["containerId"])
+  credential = conn.secrets["key"]
+  with _containers_lock:
+    entry = _containers.get(key)
+    if entry is not None and entry[0] == credential:
+      return entry[2]
+    if entry is not None:
+      # the connection key was rotated, drop the client built with the old one
+      entry[1].close()
+    client = CosmosClient(url=key[0], credential=credential)
+    container = client.get_database_client(key[1]).get_container_client(key[2])
+    _containers[key] = (credential, client, container)
+    return container
+
+@atexit.register
+def close_containers():
+  with _containers_lock:
+    for _, client, _ in _containers.values():
+      client.close()
+    _containers.clear()
+
 # The inputs section will change based on the arguments of the tool function, after you save the code
 # Adding type to arguments and return value will help the system show the types properly
 # Please update the function name/signature per need
 @tool
 def customer_lookup(customerId: str, conn: CustomConnection) -> str:
-  client = CosmosClient(url=conn.configs["endpoint"], credential=conn.secrets["key"])
-  db = client.get_database_client(conn.configs["databaseId"])
-  container = db.get_container_client(conn.configs["containerId"])
+  container = get_container(conn)
   response = container.read_item(item=customerId, partition_key=customerId)
   orders = response["orders"]
   orders = sorted(orders, key=lambda x: x["date"], reverse=True)
@@ -0,0 +1,197 @@
+"""
+Concurrent, rate-limited embedding of document chunks for init_search.py.
+
+Chunks are packed into batches by token count, batches are embedded by a pool of
+workers under a tokens-per-minute limit, and rate limited (429) or failed (5xx)
+requests are retried with exponential backoff. Embeddings come back in input order.
+"""
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Callable, List
+
+import openai
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError,
+                    openai.APIConnectionError, openai.APITimeoutError)
+
+
+class TokenRateLimiter:
+    """
+    A token bucket that refills at tokens_per_minute. acquire blocks until the
+    requested tokens are available. Tokens are whatever is being limited, exp/eval.py
+    counts requests with it.
+
+    The bucket holds burst_seconds of quota and starts empty: the service enforces its
+    per minute quota over short windows, a full minute of tokens sent at once is
+    answered with 429s.
+    """
+    def __init__(self, tokens_per_minute: int, burst_seconds: float = 10.0):
+        self.rate = tokens_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.available = 0.0
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        # a batch bigger than the bucket waits for a full bucket
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            time.sleep(wait)
+
+
+def pack_batches(token_counts: List[int], max_batch_tokens: int = 8000, max_batch_size: int = 16) -> List[List[int]]:
+    """
+    Groups consecutive input indices into batches of at most max_batch_size inputs and
+    max_batch_tokens tokens (a single larger input gets a batch of its own).
+    """
+    batches, batch, batch_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if batch and (len(batch) == max_batch_size or batch_tokens + tokens > max_batch_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _retry_after(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return min(60.0, 2 ** attempt) + random.random()
+
+
+def embed_texts(client: openai.AzureOpenAI,
+                deployment: str,
+                texts: List[str],
+                token_counts: List[int],
+                concurrency: int = 4,
+                tokens_per_minute: int = 120000,
+                max_batch_tokens: int = 8000,
+                max_retries: int = 8,
+                on_batch: Callable[[List[int], List[List[float]]], None] = None,
+                limiter: TokenRateLimiter = None) -> List[List[float]]:
+    """
+    Returns the embeddings of texts in order. on_batch(indices, embeddings) is called
+    as each batch completes, e.g. to persist embeddings before the whole run is done.
+    Pass the same limiter to calls that share a deployment, tokens_per_minute is only
+    used for a limiter of its own.
+    """
+    if limiter is None:
+        limiter = TokenRateLimiter(tokens_per_minute)
+    embeddings = [None] * len(texts)
+    batches = pack_batches(token_counts, max_batch_tokens=max_batch_tokens)
+
+    def embed_batch(batch: List[int]):
+        for attempt in range(max_retries + 1):
+            limiter.acquire(sum(token_counts[i] for i in batch))
+            try:
+                data = client.embeddings.create(model=deployment, input=[texts[i] for i in batch]).data
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                wait = _retry_after(e, attempt)
+                print(f"embedding request failed ({type(e).__name__}), retrying in {wait:.1f}s")
+                time.sleep(wait)
+        vectors = [item.embedding for item in sorted(data, key=lambda item: item.index)]
+        for i, vector in zip(batch, vectors):
+            embeddings[i] = vector
+        if on_batch is not None:
+            on_batch(batch, vectors)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # list() re-raises the first failed batch
+        list(executor.map(embed_batch, batches))
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"embedded {len(texts)} chunks ({sum(token_counts)} tokens) in {len(batches)} batches with {concurrency} workers: "
+          f"{len(texts) / elapsed:.1f} chunks/s, {sum(token_counts) / elapsed:.0f} tokens/s")
+    return embeddings
+
+
+class _FakeEmbeddings:
+    """
+    client.embeddings of a fake deployment: requests take latency plus seconds_per_token
+    per input token, and are answered with a 429 when they exceed tokens_per_minute,
+    which (like the service) is enforced over short windows, not per minute.
+    """
+    def __init__(self, tokens_per_minute: int, latency: float, seconds_per_token: float, window: float = 1.0):
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.rate = tokens_per_minute / 60
+        self.capacity = self.rate * window
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self.requests = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def create(self, model: str, input: List[str]):
+        import httpx
+        tokens = sum(len(text.split()) for text in input)
+        with self._lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.available < tokens:
+                self.throttled += 1
+                wait = (tokens - self.available) / self.rate
+                # the service sends retry-after in whole seconds
+                response = httpx.Response(429, headers={"retry-after": str(math.ceil(wait))},
+                                          request=httpx.Request("POST", "https://fake/embeddings"))
+                raise openai.RateLimitError("rate limited", response=response, body=None)
+            self.available -= tokens
+        time.sleep(self.latency + tokens * self.seconds_per_token)
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[0.0]) for i in range(len(input))])
+
+
+def benchmark(chunks: int = 400, chunk_tokens: int = 200, tokens_per_minute: int = 3000000,
+              latency: float = 0.1, seconds_per_token: float = 1e-5, concurrency=(1, 2, 4, 8, 16)) -> dict:
+    """
+    throughput of embed_texts against a fake deployment for each concurrency, with the
+    client side limit set to the deployment's quota. Returns chunks/s and the share of
+    requests that were throttled by concurrency.
+    """
+    texts = [" ".join(["word"] * chunk_tokens)] * chunks
+    token_counts = [chunk_tokens] * chunks
+    report = {}
+    for workers in concurrency:
+        embeddings = _FakeEmbeddings(tokens_per_minute, latency, seconds_per_token)
+        client = SimpleNamespace(embeddings=embeddings)
+        start_time = time.perf_counter()
+        try:
+            embed_texts(client, "fake", texts, token_counts, concurrency=workers, tokens_per_minute=tokens_per_minute)
+        except openai.RateLimitError:
+            # a batch ran out of retries
+            report[workers] = {"chunks_per_second": None, "throttled": embeddings.throttled / embeddings.requests}
+            print(f"concurrency {workers}: failed, {embeddings.throttled} of {embeddings.requests} requests throttled")
+            continue
+        elapsed = time.perf_counter() - start_time
+        report[workers] = {"chunks_per_second": chunks / elapsed,
+                           "throttled": embeddings.throttled / embeddings.requests}
+        print(f"concurrency {workers}: {chunks / elapsed:.1f} chunks/s, "
+              f"{embeddings.throttled} of {embeddings.requests} requests throttled")
+    return report
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -5,8 +5,21 @@ and semantic ranking.
 To run this code, you must already have a "Cognitive Search" and an "OpenAI"
 resource created in Azure.
 """
+import argparse
+import glob
+import hashlib
+import itertools
+import json
 import os
-
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterator
+
+import numpy as np
 import openai
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
@@ -28,15 +41,26 @@ from azure.search.documents.indexes.models import (
     VectorSearchAlgorithmMetric,
     ExhaustiveKnnAlgorithmConfiguration,
     ExhaustiveKnnParameters,
-    VectorSearchProfile
+    VectorSearchProfile,
+    BinaryQuantizationCompression,
+    RescoringOptions,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    VectorSearchCompressionRescoreStorageMethod,
 )
 from dotenv import load_dotenv
-from langchain.document_loaders import DirectoryLoader, UnstructuredMarkdownLoader
+from langchain.document_loaders import UnstructuredMarkdownLoader
 from langchain.text_splitter import Language, RecursiveCharacterTextSplitter
-import math
 import tiktoken
 load_dotenv()
 
+# the local index format is shared with the retrieval tool of the flow
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "rag_flow"))
+from local_index import LocalIndex, LocalIndexWriter, benchmark
+from embedding_cache import get_embedding_cache
+from embeddings import TokenRateLimiter, embed_texts
+from upload import upload_documents
+
 # Config for Azure Search.
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_AI_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_AI_SEARCH_KEY")
@@ -49,51 +73,143 @@ AZURE_OPENAI_API_VERSION = "2023-07-01-preview"
 AZURE_OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
 
+# Embeddings of unchanged chunks are reused from this cache instead of calling the API.
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite")
+
+# Concurrent embedding requests and the tokens per minute quota of the embedding deployment.
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", "120000"))
+
+# Concurrent upload requests to Azure AI Search.
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
 DATA_DIR = "data/product_info"
 
+# Processes that parse and split the documents, and the number of chunks that go through
+# embedding and upload together.
+LOADER_WORKERS = int(os.getenv("INDEX_LOADER_WORKERS", str(os.cpu_count() or 1)))
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "1000"))
+
+# Content hashes of the chunks in the index, used to only sync what changed.
+INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", f".cache/{AZURE_SEARCH_INDEX_NAME}.manifest.json")
+
 def read_header(file_path: str) -> str:
     # read the first 3 lines of the file
     with open(file_path, "r") as f:
-        lines = f.readlines()
-    return "\n".join(lines[:3]) + "\n"
+        lines = list(itertools.islice(f, 3))
+    return "\n".join(lines) + "\n"
 
-def load_and_split_documents() -> list[dict]:
-    """
-    Loads our documents from disc and split them into chunks.
-    Returns a list of dictionaries.
-    """
-    # Load our data.
-    loader = DirectoryLoader(
-        DATA_DIR, loader_cls=UnstructuredMarkdownLoader, show_progress=True
-    )
-    docs = loader.load()
-    print(f"loaded {len(docs)} documents")
-
-    # Split our documents.
-    splitter = RecursiveCharacterTextSplitter.from_language(
+@lru_cache(maxsize=1)
+def get_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter.from_language(
         language=Language.MARKDOWN, chunk_size=1000, chunk_overlap=100
     )
-    split_docs = splitter.split_documents(docs)
-    print(f"split into {len(split_docs)} documents")
-
-    # Convert our LangChain Documents to a list of dictionaries.
-    final_docs = []
-    for i, doc in enumerate(split_docs):
-        header = read_header(doc.metadata["source"])
-        doc_dict = {
-            "id": str(i),
+
+def split_file(file_path: str) -> list[dict]:
+    """
+    Loads one document and splits it into chunks, runs in a worker process.
+    """
+    docs = UnstructuredMarkdownLoader(file_path).load()
+    # the header is the same for every chunk of the file, read it once
+    header = read_header(file_path)
+    return [
+        {
+            "id": chunk_id(file_path, position),
             "content": header + doc.page_content,
             "title": header,
-            "sourcefile": os.path.basename(doc.metadata["source"]),
+            "sourcefile": os.path.basename(file_path),
         }
-        final_docs.append(doc_dict)
+        for position, doc in enumerate(get_splitter().split_documents(docs))
+    ]
+
+def load_and_split_documents(workers: int = LOADER_WORKERS) -> Iterator[dict]:
+    """
+    Loads our documents from disc and split them into chunks in a pool of worker
+    processes. Yields the chunks as dictionaries, file by file, with only a few files
+    in flight at a time so memory doesn't grow with the size of the corpus.
+    """
+    files = sorted(glob.glob(os.path.join(DATA_DIR, "**", "*.md"), recursive=True))
+    print(f"loading {len(files)} documents with {workers} workers")
+    chunks = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for file_path in files:
+            pending.append(executor.submit(split_file, file_path))
+            if len(pending) >= 2 * workers:
+                for doc in pending.popleft().result():
+                    chunks += 1
+                    yield doc
+        while pending:
+            for doc in pending.popleft().result():
+                chunks += 1
+                yield doc
+    print(f"split into {chunks} documents")
+
+def batched(docs: Iterator[dict], size: int) -> Iterator[list[dict]]:
+    iterator = iter(docs)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def chunk_id(source: str, position: int) -> str:
+    """
+    A stable id for the chunk at position in the source file, so an unchanged chunk
+    keeps its id when other files change. Keys may only contain letters, digits, _, - and =.
+    """
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return f"{re.sub(r'[^A-Za-z0-9_=-]', '_', stem)}-{position}"
+
 
-    return final_docs
+def content_hash(doc: dict) -> str:
+    return hashlib.sha256(json.dumps([doc["title"], doc["content"], doc["sourcefile"]]).encode("utf-8")).hexdigest()
 
 
-def get_index(name: str) -> SearchIndex:
+def load_manifest() -> dict:
+    if not os.path.exists(INDEX_MANIFEST_PATH):
+        return {}
+    with open(INDEX_MANIFEST_PATH) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict):
+    if os.path.dirname(INDEX_MANIFEST_PATH):
+        os.makedirs(os.path.dirname(INDEX_MANIFEST_PATH), exist_ok=True)
+    with open(INDEX_MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def get_compression(quantization: str, dimensions: int = None, oversampling: float = 4.0):
     """
-    Returns an Azure Cognitive Search index with the given name.
+    Returns the vector compression for quantization ("int8" or "binary"), optionally
+    truncated to dimensions. The full precision vectors are kept to rescore the
+    top candidates, oversampling times as many as requested.
+    """
+    rescoring = RescoringOptions(
+        enable_rescoring=True,
+        default_oversampling=oversampling,
+        rescore_storage_method=VectorSearchCompressionRescoreStorageMethod.PRESERVE_ORIGINALS
+    )
+    if quantization == "int8":
+        return ScalarQuantizationCompression(
+            compression_name="myCompression",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            rescoring_options=rescoring,
+            truncation_dimension=dimensions
+        )
+    if quantization == "binary":
+        return BinaryQuantizationCompression(
+            compression_name="myCompression",
+            rescoring_options=rescoring,
+            truncation_dimension=dimensions
+        )
+    raise ValueError(f"unknown quantization: {quantization}")
+
+
+def get_index(name: str, quantization: str = None, dimensions: int = None) -> SearchIndex:
+    """
+    Returns an Azure Cognitive Search index with the given name. With quantization
+    ("int8" or "binary") the HNSW graph is built on compressed vectors, optionally
+    truncated to the first dimensions.
     """
     # The fields we want to index. The "embedding" field is a vector field that will
     # be used for vector search.
@@ -150,12 +266,14 @@ def get_index(name: str) -> SearchIndex:
             VectorSearchProfile(
                 name="myHnswProfile",
                 algorithm_configuration_name="myHnsw",
+                compression_name="myCompression" if quantization else None,
             ),
             VectorSearchProfile(
                 name="myExhaustiveKnnProfile",
                 algorithm_configuration_name="myExhaustiveKnn",
             )
-        ]
+        ],
+        compressions=[get_compression(quantization, dimensions)] if quantization else None
     )
 
     # Create the semantic settings with the configuration
@@ -173,54 +291,178 @@ def get_index(name: str) -> SearchIndex:
 
 
 
-def initialize(search_index_client: SearchIndexClient):
-    """
-    Initializes an Azure Cognitive Search index with our custom data, using vector
-    search.
-    """
-    aoai_client = openai.AzureOpenAI(
+def get_aoai_client() -> openai.AzureOpenAI:
+    return openai.AzureOpenAI(
         api_key = AZURE_OPENAI_API_KEY,  
         api_version = AZURE_OPENAI_API_VERSION,
-        azure_endpoint = AZURE_OPENAI_API_BASE 
+        azure_endpoint = AZURE_OPENAI_API_BASE,
+        # retries are handled by embed_texts, with backoff shared with the rate limiter
+        max_retries = 0
     )
 
-    # Load our data.
-    docs = load_and_split_documents()
 
-    # count the tokens in each document (for rag retrieval, not for the embedding)
+def embed_documents(docs: list[dict], aoai_client: openai.AzureOpenAI, limiter: TokenRateLimiter,
+                    embedding_cache: bool = True):
+    """
+    Adds an "embedding" to each document, reusing cached embeddings where possible.
+    The client and the rate limiter are shared by all batches of a run.
+    """
+    if len(docs) == 0:
+        return
+
+    # count the tokens in each document (for rag retrieval and to pack the embedding batches,
+    # gpt-3.5-turbo and text-embedding-ada-002 share the cl100k_base encoding)
     encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
     token_sizes = [len(encoding.encode(doc["content"])) for doc in docs]
-    batch_size = 16
-    num_batches = math.ceil(len(docs) / batch_size)
+
+    # Reuse the embeddings of chunks we have embedded before.
+    cache = get_embedding_cache(EMBEDDING_CACHE_PATH) if embedding_cache else None
+    if cache is not None:
+        cached = cache.get_many(AZURE_OPENAI_EMBEDDING_DEPLOYMENT, [doc["content"] for doc in docs])
+        for doc, embedding in zip(docs, cached):
+            if embedding is not None:
+                doc["embedding"] = embedding
+    missing = [i for i, doc in enumerate(docs) if "embedding" not in doc]
 
     # Embed our documents.
-    print(f"embedding {len(docs)} documents in {num_batches} batches of {batch_size}. using embedding deployment {AZURE_OPENAI_EMBEDDING_DEPLOYMENT}")
+    print(f"{len(docs) - len(missing)} of {len(docs)} documents found in the embedding cache")
+    print(f"embedding {len(missing)} documents with {EMBEDDING_CONCURRENCY} workers at up to {EMBEDDING_TOKENS_PER_MINUTE} tokens per minute. using embedding deployment {AZURE_OPENAI_EMBEDDING_DEPLOYMENT}")
     print(f"Total tokens: {sum(token_sizes)}, average tokens: {int(sum(token_sizes) / len(token_sizes))}")
-    for i in range(num_batches):
-        start_idx = i * batch_size
-        end_idx = min(start_idx + batch_size, len(docs))
-        batch_docs = docs[start_idx:end_idx]
-        embeddings = aoai_client.embeddings.create(
-            model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
-            input=[doc["content"] for doc in batch_docs]
-        ).data
-
-        for j, doc in enumerate(batch_docs):
-            doc["embedding"] = embeddings[j].embedding
-
-    # Create an Azure Cognitive Search index.
-    print(f"creating index {AZURE_SEARCH_INDEX_NAME}")
-    index = get_index(AZURE_SEARCH_INDEX_NAME)
-    search_index_client.create_or_update_index(index)
-
-    # Upload our data to the index.
-    search_client = SearchClient(
-        endpoint=AZURE_SEARCH_ENDPOINT,
-        index_name=AZURE_SEARCH_INDEX_NAME,
-        credential=AzureKeyCredential(AZURE_SEARCH_KEY),
-    )
-    print(f"uploading {len(docs)} documents to index {AZURE_SEARCH_INDEX_NAME}")
-    search_client.upload_documents(docs)
+    if len(missing) == 0:
+        return
+    texts = [docs[i]["content"] for i in missing]
+
+    def store_batch(batch, vectors):
+        # cache each batch as it completes, so an interrupted run doesn't lose it
+        if cache is not None:
+            cache.put_many(AZURE_OPENAI_EMBEDDING_DEPLOYMENT, [texts[i] for i in batch], vectors)
+
+    embeddings = embed_texts(aoai_client, AZURE_OPENAI_EMBEDDING_DEPLOYMENT, texts,
+                             [token_sizes[i] for i in missing],
+                             concurrency=EMBEDDING_CONCURRENCY,
+                             on_batch=store_batch,
+                             limiter=limiter)
+    for i, embedding in zip(missing, embeddings):
+        docs[i]["embedding"] = embedding
+
+
+def question_embeddings(aoai_client: openai.AzureOpenAI, limiter: TokenRateLimiter, embedding_cache: bool = True,
+                        test_set_file: str = "data/testdata.jsonl") -> np.ndarray:
+    """
+    the embeddings of the questions of the test set, the queries of the local index
+    benchmark, or None without a test set
+    """
+    if not os.path.exists(test_set_file):
+        print(f"no {test_set_file}, skipping the local index benchmark")
+        return None
+    with open(test_set_file) as f:
+        questions = list(dict.fromkeys(json.loads(line)["question"] for line in f if line.strip()))
+    docs = [{"content": question} for question in questions]
+    embed_documents(docs, aoai_client, limiter, embedding_cache=embedding_cache)
+    return np.asarray([doc["embedding"] for doc in docs], dtype=np.float32)
+
+
+def initialize(search_index_client: SearchIndexClient, local_index: str = None, hnsw: bool = False, 
+               embedding_cache: bool = True, incremental: bool = False,
+               quantization: str = None, dimensions: int = None, reduction: str = "truncate"):
+    """
+    Initializes an Azure Cognitive Search index with our custom data, using vector
+    search. If local_index is given, the embedded chunks are also written as a local
+    index to that directory. Without a search_index_client only the local index is built.
+
+    In incremental mode the existing index is kept: only new or changed chunks (by the
+    content hashes in the manifest) are embedded and upserted, and chunks that no longer
+    exist are deleted.
+
+    Chunks stream through loading, embedding and upload in batches of INDEX_BATCH_SIZE.
+
+    quantization ("int8" or "binary") and dimensions compress the vectors of both
+    indexes, reduction ("truncate" or "pca") applies to the local index only, the
+    Azure index can only be truncated.
+    """
+    search_client = None
+    if search_index_client is not None:
+        # Create an Azure Cognitive Search index.
+        print(f"creating index {AZURE_SEARCH_INDEX_NAME}")
+        if reduction == "pca" and dimensions:
+            print("PCA is only applied to the local index, the vectors of the Azure index are kept at full size")
+        elif dimensions and not quantization:
+            # the Azure index only truncates vectors as part of its compression settings
+            print("--dimensions needs --quantization for the Azure index, its vectors are kept at full size")
+        index = get_index(AZURE_SEARCH_INDEX_NAME, quantization=quantization,
+                          dimensions=dimensions if quantization and reduction == "truncate" else None)
+        search_index_client.create_or_update_index(index)
+        search_client = SearchClient(
+            endpoint=AZURE_SEARCH_ENDPOINT,
+            index_name=AZURE_SEARCH_INDEX_NAME,
+            credential=AzureKeyCredential(AZURE_SEARCH_KEY),
+        )
+
+    writer = LocalIndexWriter(local_index, hnsw=hnsw, quantization=quantization, dimensions=dimensions,
+                              reduction=reduction) if local_index is not None else None
+    previous = load_manifest() if incremental and search_client is not None else {}
+    # one client and one rate limiter for the whole run, the tokens per minute limit
+    # applies across batches
+    aoai_client = get_aoai_client()
+    limiter = TokenRateLimiter(EMBEDDING_TOKENS_PER_MINUTE)
+    # only the content hashes of the chunks are kept for the whole run
+    manifest = {}
+    failed = {}
+    total = changed = 0
+    start_time = time.time()
+
+    # Load, embed and upload our data a batch of chunks at a time.
+    for docs in batched(load_and_split_documents(), INDEX_BATCH_SIZE):
+        changed_docs = docs
+        if incremental and search_client is not None:
+            changed_docs = [doc for doc in docs if previous.get(doc["id"]) != content_hash(doc)]
+        total += len(docs)
+        changed += len(changed_docs)
+
+        # The local index is always written in full, the embedding cache makes that cheap.
+        embed_documents(docs if writer is not None else changed_docs, aoai_client, limiter,
+                        embedding_cache=embedding_cache)
+        if writer is not None:
+            writer.add(docs)
+
+        if search_client is not None and changed_docs:
+            # Upload our data to the index.
+            print(f"uploading {len(changed_docs)} documents to index {AZURE_SEARCH_INDEX_NAME}")
+            failed.update(upload_documents(search_client, changed_docs, concurrency=UPLOAD_CONCURRENCY))
+        # failed chunks stay out of the manifest, so the next incremental run retries them
+        manifest.update((doc["id"], content_hash(doc)) for doc in docs if doc["id"] not in failed)
+
+    if incremental and search_client is not None:
+        print(f"{changed} of {total} chunks were new or changed")
+    if search_client is not None:
+        elapsed = max(time.time() - start_time, 1e-9)
+        print(f"indexed {changed - len(failed)} documents in {elapsed:.1f}s: {(changed - len(failed)) / elapsed:.1f} documents/s")
+
+    if writer is not None:
+        print(f"writing local index to {local_index}")
+        writer.close()
+        index = LocalIndex(local_index)
+        queries = question_embeddings(aoai_client, limiter, embedding_cache) if hnsw or index.compressor is not None else None
+        if queries is not None and len(queries):
+            # questions as queries: a chunk embedding would be its own nearest neighbour
+            for row in benchmark(index, queries):
+                print(f"{row['mode']}: {row['bytes_per_vector']} bytes per vector, {row['ms_per_query']:.2f} ms per query, " +
+                      ", ".join(f"{key} {value:.3f}" for key, value in row.items() if key.startswith("recall")))
+
+    if search_client is None:
+        return
+
+    if incremental:
+        # Remove chunks of deleted files, or chunks past the new end of a shorter file.
+        orphans = [result["id"] for result in search_client.search(search_text="*", select=["id"])
+                   if result["id"] not in manifest and result["id"] not in failed]
+        print(f"deleting {len(orphans)} orphaned documents from index {AZURE_SEARCH_INDEX_NAME}")
+        for ids in batched(orphans, 1000):
+            search_client.delete_documents([{"id": id} for id in ids])
+
+    save_manifest(manifest)
+    if failed:
+        raise RuntimeError(f"{len(failed)} documents could not be indexed, run again with --incremental to retry them")
 
 
 def delete(search_index_client: SearchIndexClient):
@@ -234,17 +476,37 @@ def delete(search_index_client: SearchIndexClient):
 def main():
     load_dotenv()
 
+    parser = argparse.ArgumentParser(description="Create the search index for the product manuals")
+    parser.add_argument("--local-index", help="also write a local index to this directory (e.g. data/local_index)")
+    parser.add_argument("--hnsw", action="store_true", help="add an HNSW graph to the local index")
+    parser.add_argument("--local-only", action="store_true", help="only build the local index, leave Azure AI Search untouched")
+    parser.add_argument("--quantization", choices=["int8", "binary"], help="store quantized vectors, rescored with the full precision ones")
+    parser.add_argument("--dimensions", type=int, help="reduce the stored vectors to this many dimensions")
+    parser.add_argument("--reduction", choices=["truncate", "pca"], default="truncate", help="how --dimensions are reduced (pca: local index only)")
+    parser.add_argument("--no-embedding-cache", action="store_true", help=f"re-embed every chunk instead of reusing {EMBEDDING_CACHE_PATH}")
+    parser.add_argument("--incremental", action="store_true", help="sync only new, changed and deleted chunks instead of rebuilding the index")
+    args = parser.parse_args()
+
     openai.api_type = AZURE_OPENAI_API_TYPE
     openai.api_base = AZURE_OPENAI_API_BASE
     openai.api_version = AZURE_OPENAI_API_VERSION
     openai.api_key = AZURE_OPENAI_API_KEY
 
+    if args.local_only:
+        initialize(None, local_index=args.local_index or "data/local_index", hnsw=args.hnsw, 
+                   embedding_cache=not args.no_embedding_cache, quantization=args.quantization,
+                   dimensions=args.dimensions, reduction=args.reduction)
+        return
+
     search_index_client = SearchIndexClient(
         AZURE_SEARCH_ENDPOINT, AzureKeyCredential(AZURE_SEARCH_KEY)
     )
 
-    delete(search_index_client)
-    initialize(search_index_client)
+    if not args.incremental:
+        delete(search_index_client)
+    initialize(search_index_client, local_index=args.local_index, hnsw=args.hnsw, 
+               embedding_cache=not args.no_embedding_cache, incremental=args.incremental,
+               quantization=args.quantization, dimensions=args.dimensions, reduction=args.reduction)
 
 
 if __name__ == "__main__":
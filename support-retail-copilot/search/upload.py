@@ -0,0 +1,112 @@
+"""
+Batched, concurrent upload of chunks to Azure AI Search for init_search.py.
+
+Documents are packed into requests below the service limits (1000 documents and
+16 MB per request), requests are sent by a pool of workers, and documents the
+service rejected with a transient status (throttling, conflicts, unavailability)
+are retried with exponential backoff. Documents that still fail are reported by key.
+"""
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.search.documents import SearchClient
+
+# the service accepts at most 1000 documents and 16 MB per request, leave room for the envelope
+MAX_BATCH_SIZE = 1000
+MAX_BATCH_BYTES = 12 * 1024 * 1024
+
+# per document status codes that are worth retrying
+RETRYABLE_STATUS = {409, 422, 429, 503}
+RETRYABLE_ERRORS = (ServiceRequestError, ServiceResponseError)
+
+
+def document_bytes(doc: dict) -> int:
+    return len(json.dumps(doc).encode("utf-8"))
+
+
+def pack_upload_batches(docs: List[dict], max_batch_bytes: int = MAX_BATCH_BYTES,
+                        max_batch_size: int = MAX_BATCH_SIZE) -> List[List[dict]]:
+    """
+    Groups consecutive documents into batches of at most max_batch_size documents and
+    max_batch_bytes bytes of JSON (a single larger document gets a batch of its own).
+    """
+    batches, batch, batch_bytes = [], [], 0
+    for doc in docs:
+        size = document_bytes(doc)
+        if batch and (len(batch) == max_batch_size or batch_bytes + size > max_batch_bytes):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(doc)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    return isinstance(error, HttpResponseError) and (error.status_code in RETRYABLE_STATUS or (error.status_code or 0) >= 500)
+
+
+def _backoff(attempt: int) -> float:
+    return min(60.0, 2 ** attempt) + random.random()
+
+
+def upload_documents(search_client: SearchClient,
+                     docs: List[dict],
+                     concurrency: int = 4,
+                     max_retries: int = 5,
+                     key_field: str = "id") -> Dict[str, str]:
+    """
+    Merges or uploads docs into the index of search_client. Returns the keys of the
+    documents that could not be indexed, with the last error message for each.
+    """
+    def upload_batch(batch: List[dict]) -> Dict[str, str]:
+        failed = {}
+        for attempt in range(max_retries + 1):
+            try:
+                results = search_client.merge_or_upload_documents(batch)
+            except (HttpResponseError,) + RETRYABLE_ERRORS as e:
+                if not _is_retryable(e):
+                    raise
+                if attempt == max_retries:
+                    failed.update((doc[key_field], str(e)) for doc in batch)
+                    return failed
+                wait = _backoff(attempt)
+                print(f"upload of {len(batch)} documents failed ({type(e).__name__}), retrying in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+            retry = set()
+            for result in results:
+                if result.succeeded:
+                    continue
+                if result.status_code in RETRYABLE_STATUS and attempt < max_retries:
+                    retry.add(result.key)
+                else:
+                    failed[result.key] = result.error_message or f"status {result.status_code}"
+            if not retry:
+                return failed
+            # send only the documents that failed with a transient status again
+            batch = [doc for doc in batch if doc[key_field] in retry]
+            wait = _backoff(attempt)
+            print(f"{len(batch)} documents were not indexed, retrying in {wait:.1f}s")
+            time.sleep(wait)
+        return failed
+
+    batches = pack_upload_batches(docs)
+    start_time = time.time()
+    failed = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for batch_failed in executor.map(upload_batch, batches):
+            failed.update(batch_failed)
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"indexed {len(docs) - len(failed)} of {len(docs)} documents in {len(batches)} requests with {concurrency} workers: "
+          f"{(len(docs) - len(failed)) / elapsed:.1f} documents/s")
+    for key, error in failed.items():
+        print(f"failed to index document {key}: {error}")
+    return failed
@@ -0,0 +1,23 @@
+import threading
+import openai
+from promptflow.connections import AzureOpenAIConnection
+
+# openai clients hold an HTTP connection pool, so the tools share one client per
+# (endpoint, api version) instead of creating one on every call
+_clients = {}
+_lock = threading.Lock()
+
+def get_aoai_client(connection: AzureOpenAIConnection) -> openai.AzureOpenAI:
+    key = (connection.api_base, connection.api_version)
+    with _lock:
+        entry = _clients.get(key)
+        if entry is None or entry[0] != connection.api_key:
+            # new endpoint or a rotated key
+            client = openai.AzureOpenAI(
+                api_key = connection.api_key,  
+                api_version = connection.api_version,
+                azure_endpoint = connection.api_base 
+            )
+            entry = (connection.api_key, client)
+            _clients[key] = entry
+        return entry[1]
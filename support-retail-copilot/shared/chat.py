@@ -0,0 +1,30 @@
+from promptflow import tool
+from promptflow.connections import AzureOpenAIConnection
+from promptflow.tools.common import parse_chat
+from aoai_clients import get_aoai_client
+import llm_cache
+
+@tool(streaming_option_parameter="stream")
+def chat(prompt: str,
+         connection: AzureOpenAIConnection,
+         deployment_name: str,
+         temperature: float = 1.0,
+         max_tokens: int = None,
+         response_format: dict = None,
+         stream: bool = False):
+    """
+    chat completion for a rendered chat prompt (system:/user:/assistant: sections),
+    served from the LLM cache when it is configured and the call is deterministic.
+    response_format is passed to the API as is, e.g. {"type": "json_object"}.
+    """
+    messages = parse_chat(prompt)
+    params = {"temperature": temperature}
+    if max_tokens is not None:
+        params["max_tokens"] = max_tokens
+    if response_format:
+        # part of the cache key with the other parameters
+        params["response_format"] = response_format
+    client = get_aoai_client(connection)
+    if stream:
+        return llm_cache.stream_chat_completion(client, deployment_name, messages, **params)
+    return llm_cache.chat_completion(client, deployment_name, messages, **params)
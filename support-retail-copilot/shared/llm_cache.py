@@ -0,0 +1,120 @@
+"""
+Opt-in on-disk cache for deterministic (temperature 0) chat completions, so re-running
+an unchanged test set doesn't repeat the same LLM calls.
+
+Configured with environment variables:
+  LLM_CACHE_PATH         SQLite file of the cache, the cache is off when this is not set
+  LLM_CACHE_MAX_ENTRIES  least recently used responses beyond this are evicted (default 10000)
+  LLM_CACHE_BYPASS       set to 1 to ignore cached responses (fresh ones are still stored)
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+
+    @staticmethod
+    def key(deployment: str, messages: list, params: dict) -> str:
+        request = json.dumps({"deployment": deployment, "messages": messages, "params": params}, sort_keys=True)
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, response, accessed) VALUES (?, ?, ?)",
+                             (key, response, time.time()))
+            count = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                                 (count - self.max_entries,))
+                self.evictions += count - self.max_entries
+            self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_llm_cache():
+    """returns the configured cache, or None when caching is off"""
+    path = os.getenv("LLM_CACHE_PATH")
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = LLMCache(path, max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")))
+        return _caches[path]
+
+
+def _lookup(deployment: str, messages: list, params: dict):
+    """returns (cache, key, cached response) for cacheable requests, (None, None, None) otherwise"""
+    cache = get_llm_cache()
+    # only deterministic calls can be served from the cache
+    if cache is None or params.get("temperature", 1) != 0:
+        return None, None, None
+    key = cache.key(deployment, messages, params)
+    if os.getenv("LLM_CACHE_BYPASS") == "1":
+        return cache, key, None
+    return cache, key, cache.get(key)
+
+
+def chat_completion(client, deployment: str, messages: list, **params) -> str:
+    cache, key, response = _lookup(deployment, messages, params)
+    if response is not None:
+        return response
+    completion = client.chat.completions.create(model=deployment, messages=messages, **params)
+    response = completion.choices[0].message.content
+    if cache is not None:
+        cache.put(key, response)
+    return response
+
+
+def stream_chat_completion(client, deployment: str, messages: list, **params):
+    """yields the tokens of the response, a cached response comes as a single token"""
+    cache, key, response = _lookup(deployment, messages, params)
+    if response is not None:
+        yield response
+        return
+    tokens = []
+    for chunk in client.chat.completions.create(model=deployment, messages=messages, stream=True, **params):
+        if chunk.choices and chunk.choices[0].delta.content:
+            tokens.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+    if cache is not None:
+        cache.put(key, "".join(tokens))